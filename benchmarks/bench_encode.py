@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Compare the pay request encoder with the previous dict and urlencode path.
+
+Encodes pay requests with growing order item lists. Both paths must give 
+the same fields: the old path emits them in dict order, the encoder in the
+order they are added, so bodies are compared as sorted lists of fields.
+
+    $ python benchmarks/bench_encode.py [--repeat N]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+import urllib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixtures
+import payson_api
+
+
+def legacy_encode(returnUrl, cancelUrl, memo, senderEmail, senderFirstName,
+                  senderLastName, receiverList, orderItemList,
+                  fundingList=(), custom=None, trackingId=None):
+    """Request encoding as done by PaysonApi.pay before the encoder."""
+    pay_request = {'returnUrl': returnUrl,
+                   'cancelUrl': cancelUrl,
+                   'memo': memo.encode('utf-8'),
+                   'senderEmail': senderEmail.encode('utf-8'),
+                   'senderFirstName': senderFirstName.encode('utf-8'),
+                   'senderLastName': senderLastName.encode('utf-8')}
+    for i, v in enumerate(receiverList):
+        k = 'receiverList.receiver(%d).%s'
+        pay_request[k % (i, 'email')] = v.email.encode('utf-8')
+        pay_request[k % (i, 'amount')] = str(v.amount)
+        if v.primary is not None:
+            pay_request[k % (i, 'primary')] = json.dumps(v.primary)
+        if v.firstName:
+            pay_request[k % (i, 'firstName')] = v.firstName.encode('utf-8')
+        if v.lastName:
+            pay_request[k % (i, 'lastName')] = v.lastName.encode('utf-8')
+    for i, v in enumerate(fundingList):
+        pay_request['fundingList.fundingConstraint'
+                    '(%d).constraint' % i] = v
+    if custom is not None:
+        pay_request['custom'] = json.dumps(custom)
+    if trackingId is not None:
+        pay_request['trackingId'] = trackingId.encode('utf-8')
+    for i, v in enumerate(orderItemList):
+        k = 'orderItemList.orderItem(%d).%s'
+        pay_request[k % (i, 'description')] = v.description.encode('utf-8')
+        pay_request[k % (i, 'sku')] = str(v.sku)
+        pay_request[k % (i, 'quantity')] = str(v.quantity)
+        pay_request[k % (i, 'unitPrice')] = str(v.unitPrice)
+        pay_request[k % (i, 'taxPercentage')] = str(v.taxPercentage)
+    return urllib.urlencode(pay_request)
+
+
+class CapturingTransport(fixtures.CannedTransport):
+    """Keeps the last request body."""
+
+    def send(self, url, body, headers, timings=None, timeout=None):
+        self.query = body
+        return self.body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    transport = CapturingTransport(urllib.urlencode(
+        fixtures.envelope() + [('TOKEN', 'token')]))
+    api = payson_api.PaysonApi(payson_api.PAYSON_TEST_AGENT_ID[0],
+                               payson_api.PAYSON_TEST_AGENT_KEY[0],
+                               transport=transport)
+    print '%-10s %12s %12s %8s' % ('items', 'legacy us', 'encoder us',
+                                   'speedup')
+    for items in (1, 10, 100, 1000):
+        request = fixtures.pay_request(items)
+        api.pay(**request)
+        expected = legacy_encode(**request)
+        assert sorted(transport.query.split('&')) == sorted(expected.split('&'))
+        number = max(1, 2000 // items)
+        times = []
+        for func in (lambda: legacy_encode(**request),
+                     lambda: api.pay(**request)):
+            best = min(timeit.repeat(func, number=number,
+                                     repeat=args.repeat))
+            times.append(best / number * 1e6)
+        print '%-10d %12.1f %12.1f %7.1fx' % (items, times[0], times[1],
+                                              times[0] / times[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Memory and CPU cost of holding many parsed IPN messages.
+
+Parses a number of distinct IPN messages into PaymentDetails, reading only
+status and token like a typical IPN worker, and keeps them all in memory.
+The previous eager, dict based model classes are compared with the current
+lazy, slot based ones, reading a decoded dict or the raw message through
+RawResponseData. With --archive the raw messages are kept as well, as by a
+worker archiving them. Each variant runs in a fresh interpreter.
+
+    $ python benchmarks/bench_models.py [--count N] [--archive]
+"""
+import argparse
+import datetime
+import decimal
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixtures
+import payson_api
+
+
+class LegacyReceiver(object):
+
+    def __init__(self, email, amount, primary=None):
+        self.email = email
+        self.amount = decimal.Decimal(amount)
+        self.primary = primary
+        self.firstName = None
+        self.lastName = None
+
+
+class LegacyPaymentDetails(object):
+    """PaymentDetails as it was before lazy decoding."""
+
+    def __init__(self, data):
+        self.purchaseId = data.get('purchaseId', '')
+        self.token = data.get('token')
+        self.senderEmail = data.get('senderEmail', '')
+        self.status = data['status']
+        self.type = data['type']
+        self.guaranteeStatus = data.get('guaranteeStatus')
+        self.guaranteeDeadlineTimestamp = datetime.datetime.strptime(
+            data['guaranteeDeadlineTimestamp'], '%Y-%m-%dT%H:%M:%S') \
+            if 'guaranteeDeadlineTimestamp' in data else None
+        self.invoiceStatus = data.get('invoiceStatus')
+        custom = data.get('custom')
+        self.custom = custom and json.loads(custom)
+        self.trackingId = data.get('trackingId', '').decode('utf-8')
+        self.currencyCode = data['currencyCode']
+        self.receiverFee = decimal.Decimal(data.get('receiverFee', '0'))
+        self.receiverList = []
+        i = 0
+        while 'receiverList.receiver(%d).email' % i in data:
+            primary = data.get('receiverList.receiver(%d).primary' % i)
+            primary = json.loads(primary.lower()) if primary else None
+            self.receiverList.append(LegacyReceiver(
+                data['receiverList.receiver(%d).email' % i],
+                data['receiverList.receiver(%d).amount' % i],
+                primary))
+            i += 1
+        self.post_data = data.copy()
+
+
+def legacy(body):
+    data = {k: v[0] for k, v in urlparse.parse_qs(body).items()}
+    return LegacyPaymentDetails(data)
+
+
+def current(body):
+    return payson_api.PaymentDetails(payson_api.decode_response(body))
+
+
+def raw(body):
+    return payson_api.PaymentDetails(payson_api.RawResponseData(body))
+
+
+VARIANTS = {'legacy': legacy, 'current': current, 'raw': raw}
+
+
+def measure(variant, count, archive):
+    parse = VARIANTS[variant]
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.clock()
+    kept = []
+    for i in xrange(count):
+        body = fixtures.ipn_body(i)
+        details = parse(body)
+        details.status, details.token
+        if archive and variant != 'raw':
+            kept.append((body, details))
+        else:
+            kept.append(details)
+    cpu = time.clock() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    return {'variant': variant, 'count': count, 'cpu_seconds': cpu,
+            'rss_kb': rss}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--archive', action='store_true',
+                        help='keep the raw messages too')
+    parser.add_argument('--variant', choices=sorted(VARIANTS))
+    args = parser.parse_args()
+    if args.variant:
+        print json.dumps(measure(args.variant, args.count, args.archive))
+        return
+    print '%-8s %10s %12s %14s' % ('variant', 'cpu s', 'rss MB',
+                                   'bytes/message')
+    for variant in ('legacy', 'current', 'raw'):
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__),
+             '--variant', variant, '--count', str(args.count)] +
+            (['--archive'] if args.archive else []))
+        result = json.loads(output)
+        print '%-8s %10.2f %12.1f %14.0f' % (
+            variant, result['cpu_seconds'], result['rss_kb'] / 1024.0,
+            result['rss_kb'] * 1024.0 / args.count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Compare decode_response against the previous parse_qs based parsing.
+
+Times decoding of PaymentDetails responses with growing receiver and 
+error lists, including building Receiver and Error lists from the result.
+
+    $ python benchmarks/bench_parse.py [--repeat N]
+"""
+import argparse
+import os
+import sys
+import timeit
+import urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixtures
+import payson_api
+
+
+def legacy(body):
+    data = urlparse.parse_qs(body)
+    data = {k: v[0] for k, v in data.items()}
+    return (payson_api.Receiver.from_response_data(data),
+            payson_api.Error.from_response_dict(data))
+
+
+def current(body):
+    data = payson_api.decode_response(body)
+    return (payson_api.Receiver.from_response_data(data),
+            payson_api.Error.from_response_dict(data))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    print '%-10s %12s %12s %8s' % ('size', 'legacy us', 'decode us', 'speedup')
+    for size in (1, 10, 100, 1000):
+        body = fixtures.payment_details_body(size, size)
+        number = max(1, 2000 // size)
+        times = []
+        for func in (legacy, current):
+            best = min(timeit.repeat(lambda: func(body), number=number,
+                                     repeat=args.repeat))
+            times.append(best / number * 1e6)
+        print '%-10d %12.1f %12.1f %7.1fx' % (size, times[0], times[1],
+                                              times[0] / times[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Compare urllib2 against the pooled keep-alive transport.
+
+Starts a local stub Payson server answering Validate requests and times
+a number of sequential and concurrent calls through both transports.
+
+    $ python benchmarks/bench_pool.py [--requests N] [--threads N]
+                                      [--certfile server.pem]
+
+With --certfile the stub server speaks HTTPS using the given PEM file 
+(certificate and private key), which includes the TLS handshake in the
+numbers. Certificate verification is disabled for the stub.
+"""
+import argparse
+import BaseHTTPServer
+import functools
+import os
+import SocketServer
+import ssl
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import payson_api
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Length', '8')
+        self.end_headers()
+        self.wfile.write('VERIFIED')
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def start_server(certfile=None):
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    scheme = 'http'
+    if certfile:
+        server.socket = ssl.wrap_socket(server.socket, certfile=certfile,
+                                        server_side=True)
+        scheme = 'https'
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, '%s://127.0.0.1:%d' % (scheme, server.server_port)
+
+
+def make_pool(context):
+    pool = payson_api.ConnectionPool()
+    if context is not None:
+        pool.connection_classes = dict(
+            pool.connection_classes,
+            https=functools.partial(payson_api.httplib.HTTPSConnection,
+                                    context=context))
+    return pool
+
+
+def run(api, requests, threads):
+    per_thread = requests // threads
+
+    def worker():
+        for _ in xrange(per_thread):
+            api.validate('token=abc')
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.time() - start
+    return per_thread * threads / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--certfile')
+    args = parser.parse_args()
+
+    server, url = start_server(args.certfile)
+    context = ssl._create_unverified_context() if args.certfile else None
+    user = (payson_api.PAYSON_TEST_AGENT_ID[0],
+            payson_api.PAYSON_TEST_AGENT_KEY[0])
+    plain = payson_api.PaysonApi(
+        *user, endpoint=url,
+        transport=payson_api.UrllibTransport(context=context))
+    pooled = payson_api.PaysonApi(*user, endpoint=url,
+                                  pool=make_pool(context))
+    try:
+        for name, api in (('urllib2', plain), ('pooled', pooled)):
+            rate = run(api, args.requests, args.threads)
+            print '%-8s %8.0f requests/s' % (name, rate)
+        print 'pooled connections opened: %d' % (
+            pooled.transport.pool.connections_opened)
+    finally:
+        pooled.close()
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Compare to_bytes/from_bytes against pickle and re-parsing the raw body.
+
+Round-trips PaymentDetailsResponse instances with growing receiver lists,
+once as received and once with all attributes decoded, and prints the size
+of the serialized data and the time to dump and load it.
+
+    $ python benchmarks/bench_serialize.py [--repeat N]
+"""
+import argparse
+import cPickle
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixtures
+import payson_api
+
+
+def decode_all(details):
+    (details.guaranteeDeadlineTimestamp, details.custom, details.trackingId,
+     details.receiverFee, details.amount, details.responseEnvelope.timestamp)
+
+
+def variants(body):
+    def load(data):
+        return payson_api.PaymentDetailsResponse(
+            payson_api.decode_response(data))
+
+    yield 'raw body', lambda details: body, load
+    yield ('pickle', lambda details: cPickle.dumps(details, 2),
+           cPickle.loads)
+    yield ('to_bytes', lambda details: details.to_bytes(),
+           payson_api.PaymentDetailsResponse.from_bytes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    print '%-10s %-8s %-10s %8s %10s %10s' % (
+        'receivers', 'decoded', 'format', 'bytes', 'dump us', 'load us')
+    for size in (1, 10, 100):
+        body = fixtures.payment_details_body(size)
+        for decoded in (False, True):
+            details = payson_api.PaymentDetailsResponse(
+                payson_api.decode_response(body))
+            if decoded:
+                decode_all(details)
+            number = max(1, 5000 // size)
+            for name, dump, load in variants(body):
+                data = dump(details)
+                times = [min(timeit.repeat(func, number=number,
+                                           repeat=args.repeat)) / number * 1e6
+                         for func in (lambda: dump(details),
+                                      lambda: load(data))]
+                print '%-10d %-8s %-10s %8d %10.1f %10.1f' % (
+                    size, decoded, name, len(data), times[0], times[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Import time of payson_api and the cost of the first call after it.
+
+Each run starts a fresh interpreter which imports payson_api, creates a
+PaysonApi and makes one payment_details call against a canned response,
+reading the decoded amounts, timestamps and custom field. The deferred
+imports are compared with importing csv, datetime, decimal, json and
+multiprocessing.pool up front, as payson_api did before. The module is
+compiled beforehand so that compiling it is not measured.
+
+    $ python benchmarks/bench_startup.py [--repeat N]
+"""
+import argparse
+import os
+import py_compile
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixtures
+import payson_api
+
+CHILD = '''
+import sys
+import time
+body = sys.stdin.read()
+start = time.time()
+%s
+import payson_api
+imported = time.time()
+
+
+class CannedTransport(payson_api.Transport):
+
+    def send(self, url, body_, headers, timings=None, timeout=None):
+        return body
+
+api = payson_api.PaysonApi(
+    payson_api.PAYSON_TEST_AGENT_ID[0], payson_api.PAYSON_TEST_AGENT_KEY[0],
+    transport=CannedTransport())
+details = api.payment_details('token')
+details.amount, details.guaranteeDeadlineTimestamp, details.custom
+called = time.time()
+print imported - start, called - imported
+'''
+
+VARIANTS = (
+    ('eager', 'import csv, datetime, decimal, json, multiprocessing.pool'),
+    ('deferred', ''))
+
+
+def run(directory, preload, body):
+    start = time.time()
+    child = subprocess.Popen(
+        [sys.executable, '-c', CHILD % preload], stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, cwd=directory,
+        env=dict(os.environ, PYTHONPATH=directory))
+    output = child.communicate(body)[0]
+    total = time.time() - start
+    imported, called = map(float, output.split())
+    return imported, called, total
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=21)
+    args = parser.parse_args()
+    body = fixtures.payment_details_body(2)
+    directory = tempfile.mkdtemp()
+    try:
+        source = os.path.join(directory, 'payson_api.py')
+        shutil.copy(payson_api.__file__.replace('.pyc', '.py'), source)
+        py_compile.compile(source)
+        print '%-10s %10s %15s %12s' % ('variant', 'import ms',
+                                        'first call ms', 'process ms')
+        for name, preload in VARIANTS:
+            results = [run(directory, preload, body)
+                       for _ in range(args.repeat)]
+            print '%-10s %10.1f %15.1f %12.1f' % ((name, ) + tuple(
+                median(column) * 1000 for column in zip(*results)))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Compare timestamp and amount decoding against strptime and Decimal.
+
+Decodes a batch of IPN messages into PaymentDetails and reads their
+timestamp and amounts, as when processing IPNs in bulk, once with the
+previous strptime and decimal.Decimal calls and once with the current
+memoized decoders. Messages share their timestamp in runs of --per-second.
+
+    $ python benchmarks/bench_values.py [--messages N] [--per-second N]
+"""
+import argparse
+import datetime
+import decimal
+import os
+import sys
+import timeit
+import urllib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixtures
+import payson_api
+
+
+def legacy_timestamp(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+def messages(count, per_second, receivers):
+    start = datetime.datetime(2014, 3, 1, 12, 0, 0)
+    for i in range(count):
+        timestamp = start + datetime.timedelta(seconds=i // per_second)
+        fields = [(k, timestamp.strftime('%Y-%m-%dT%H:%M:%S')
+                   if k == 'guaranteeDeadlineTimestamp' else v)
+                  for k, v in fixtures.payment_fields(receivers, str(i))]
+        yield urllib.urlencode(fields)
+
+
+def process(bodies):
+    for body in bodies:
+        details = payson_api.PaymentDetails(payson_api.decode_response(body))
+        details.guaranteeDeadlineTimestamp, details.receiverFee, details.amount
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--per-second', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    current = (payson_api._parse_timestamp, payson_api._parse_decimal)
+    legacy = (legacy_timestamp, decimal.Decimal)
+    print '%-10s %12s %12s %8s' % ('receivers', 'legacy ms', 'current ms',
+                                   'speedup')
+    for receivers in (1, 2, 10):
+        bodies = list(messages(args.messages, args.per_second, receivers))
+        times = []
+        for functions in (legacy, current):
+            payson_api._parse_timestamp, payson_api._parse_decimal = functions
+            payson_api._timestamps.clear()
+            payson_api._decimals.clear()
+            times.append(min(timeit.repeat(lambda: process(bodies), number=1,
+                                           repeat=args.repeat)) * 1e3)
+        payson_api._parse_timestamp, payson_api._parse_decimal = current
+        print '%-10d %12.1f %12.1f %7.2fx' % (receivers, times[0], times[1],
+                                              times[0] / times[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Realistic Payson request arguments and NVP bodies for the benchmarks."""
+import decimal
+import json
+import os
+import sys
+import urllib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import payson_api
+
+TIMESTAMP = '2014-03-01T12:30:05'
+
+
+def envelope(ack='SUCCESS'):
+    return [('responseEnvelope.ack', ack),
+            ('responseEnvelope.timestamp', TIMESTAMP),
+            ('responseEnvelope.correlationId',
+             '7b0fae7f-6fe0-4d9a-8a2e-3f4e0c5f0d7e')]
+
+
+def payment_fields(receivers=2, order='1234'):
+    fields = [('purchaseId', order),
+              ('token', '%08d-0fd4-4b30-a4bb-8e08b5a1c0f4' % int(order)),
+              ('senderEmail', 'test-shopper@payson.se'),
+              ('status', 'COMPLETED'),
+              ('type', 'TRANSFER'),
+              ('guaranteeStatus', 'WAITINGFORSEND'),
+              ('guaranteeDeadlineTimestamp', TIMESTAMP),
+              ('custom', json.dumps({'order': order})),
+              ('trackingId', u'order-%s-åäö'.encode('utf-8') % order),
+              ('currencyCode', 'SEK'),
+              ('receiverFee', '6.75')]
+    for i in range(receivers):
+        k = 'receiverList.receiver(%d).%s'
+        fields += [(k % (i, 'email'), 'receiver-%d@example.com' % i),
+                   (k % (i, 'amount'), '%d.50' % (100 + i)),
+                   (k % (i, 'primary'), 'true' if i == 0 else 'false')]
+    return fields
+
+
+def error_fields(errors):
+    fields = []
+    for i in range(errors):
+        k = 'errorList.error(%d).%s'
+        fields += [(k % (i, 'errorId'), str(520000 + i)),
+                   (k % (i, 'message'), 'Something went wrong #%d' % i),
+                   (k % (i, 'parameter'), 'receiverList.receiver(%d)' % i)]
+    return fields
+
+
+def payment_details_body(receivers=2, errors=0):
+    """Body of a PaymentDetails response."""
+    ack = 'FAILURE' if errors else 'SUCCESS'
+    return urllib.urlencode(envelope(ack) + payment_fields(receivers) +
+                            error_fields(errors))
+
+
+def ipn_body(order=1234, receivers=2):
+    """IPN message as posted to ipnNotificationUrl."""
+    return urllib.urlencode(payment_fields(receivers, str(order)))
+
+
+def pay_request(items=10):
+    """Keyword arguments for PaysonApi.pay with items order items."""
+    receivers = [payson_api.Receiver(email='shop@example.com',
+                                     amount=decimal.Decimal('125.00'),
+                                     primary=True,
+                                     firstName=u'Åke',
+                                     lastName=u'Öster'),
+                 payson_api.Receiver(email='partner@example.com',
+                                     amount=decimal.Decimal('25.00'),
+                                     primary=False)]
+    order_items = [payson_api.OrderItem(u'Sak nummer %d, blå' % i,
+                                        'SKU-%05d' % i,
+                                        decimal.Decimal(i % 3 + 1),
+                                        decimal.Decimal('99.50'),
+                                        decimal.Decimal('0.25'))
+                   for i in range(items)]
+    return dict(returnUrl='https://shop.example.com/payson/return?o=1',
+                cancelUrl='https://shop.example.com/payson/cancel?o=1',
+                memo=u'Order 1 från Exempelbutiken',
+                senderEmail='anna.andersson@example.com',
+                senderFirstName=u'Anna',
+                senderLastName=u'Andersson',
+                receiverList=receivers,
+                orderItemList=order_items,
+                fundingList=['CARD', 'BANK'],
+                custom={'order': 1},
+                trackingId=u'order-1')
+
+
+class CannedTransport(payson_api.Transport):
+    """Answers every request with the same body, without any I/O."""
+
+    def __init__(self, body):
+        self.body = body
+
+    def send(self, url, body, headers, timings=None, timeout=None):
+        return self.body
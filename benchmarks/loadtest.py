@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+"""Load test simulating checkout and IPN traffic against the fake Payson.
+
+Drives pay, payment_details, payment_update and validate at a given mix and
+rate against a local FakePayson, over HTTP or in-process, for a number of
+seconds. Every pay is followed by the buyer completing the payment, which
+makes the fake post an IPN. validate checks those IPNs, payment_update
+refunds completed payments and payment_details looks up recent ones.
+
+Calls are made from a pool of threads using PaysonApi, or with --mode async
+through one AsyncPaysonApi with a bounded number of calls in flight. Every
+--interval seconds a line with throughput, latency percentiles, connections
+to the fake and memory is printed, a summary per call follows at the end:
+
+    $ python benchmarks/loadtest.py --duration 60 --rate 200 \\
+        --mix pay=2,payment_details=5,payment_update=1,validate=2 \\
+        --mode threads --concurrency 20 --latency 0.05 --jitter 0.02
+
+The fake runs in the same process and takes its share of the CPU, so the
+numbers are a lower bound of what the client alone can sustain. In async
+mode latencies include time queued for a worker and are accurate to about
+a millisecond. Connection counts are read from /proc and are only available
+on Linux. RSS is that of the whole process, the fake and the harness 
+included. Both keep bounded state: the fake the latest payments and IPNs, 
+the harness a sample of the latencies per call, so after warming up growth
+of RSS is the client's.
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixtures
+import payson_api
+import payson_fake
+
+USER = (payson_api.PAYSON_TEST_AGENT_ID[0], payson_api.PAYSON_TEST_AGENT_KEY[0])
+CALLS = ('pay', 'payment_details', 'payment_update', 'validate')
+PERCENTILES = (50, 90, 99)
+
+
+def parse_mix(value):
+    """'pay=2,validate=1' -> {'pay': 2.0, 'validate': 1.0}"""
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in CALLS:
+            raise argparse.ArgumentTypeError('unknown call %r' % name)
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(values, percent):
+    """Nearest rank percentile of sorted values."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+class Workload(object):
+    """Picks the next call by the mix and keeps the payments to call on.
+
+    Calls needing a completed payment or an IPN when there is none yet are
+    replaced by a pay.
+    """
+    def __init__(self, payson, mix, seed=None, max_tokens=10000):
+        self.payson = payson
+        self.request = fixtures.pay_request(10)
+        self.request['ipnNotificationUrl'] = 'http://shop.example.com/ipn'
+        self.max_tokens = max_tokens
+        self._names = sorted(mix)
+        self._cumulative = []
+        total = 0
+        for name in self._names:
+            total += mix[name]
+            self._cumulative.append(total)
+        self._random = random.Random(seed)
+        self._tokens = collections.deque(maxlen=max_tokens)
+        self._completed = collections.deque(maxlen=max_tokens)
+        self._ipns = collections.deque(maxlen=max_tokens)
+        self._lock = threading.Lock()
+        payson.ipn_handler = self._ipn
+
+    def next_call(self):
+        """Next call to make, as (name, args, kwargs)."""
+        with self._lock:
+            point = self._random.uniform(0, self._cumulative[-1])
+            name = next(n for n, c in zip(self._names, self._cumulative)
+                        if point <= c)
+            if name == 'payment_details' and self._tokens:
+                return name, (self._random.choice(self._tokens), ), {}
+            if name == 'payment_update' and self._completed:
+                return name, (self._completed.popleft(), 'REFUND'), {}
+            if name == 'validate' and self._ipns:
+                return name, (self._ipns.popleft(), ), {}
+        return 'pay', (), self.request
+
+    def finished(self, name, result):
+        """Record the result of a call, returns whether it succeeded."""
+        if name == 'pay':
+            if not result.success:
+                return False
+            self.payson.complete(result.token)
+            with self._lock:
+                self._tokens.append(result.token)
+                self._completed.append(result.token)
+            return True
+        if name == 'payment_details':
+            return result.success
+        return result
+
+    def _ipn(self, url, message):
+        self._ipns.append(message)
+
+
+class Stats(object):
+    """Latencies and outcomes per call, in total and per interval.
+
+    In total a uniform sample of at most max_samples latencies is kept per
+    call, with their count and maximum.
+    """
+
+    def __init__(self, max_samples=10000, seed=None):
+        self.max_samples = max_samples
+        self.total = collections.defaultdict(list)
+        self.counts = collections.Counter()
+        self.maximum = collections.defaultdict(float)
+        self.failed = collections.Counter()
+        self.errors = collections.Counter()
+        self._interval = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, succeeded=True, error=None):
+        with self._lock:
+            self.counts[name] += 1
+            self.maximum[name] = max(self.maximum[name], seconds)
+            samples = self.total[name]
+            if len(samples) < self.max_samples:
+                samples.append(seconds)
+            else:
+                index = self._random.randrange(self.counts[name])
+                if index < self.max_samples:
+                    samples[index] = seconds
+            self._interval.append(seconds)
+            if error is not None:
+                self.errors[name] += 1
+            elif not succeeded:
+                self.failed[name] += 1
+
+    def take_interval(self):
+        with self._lock:
+            interval, self._interval = self._interval, []
+        return sorted(interval)
+
+
+def _tcp_connections(port):
+    """Established and TIME_WAIT TCP connections to port, from /proc."""
+    states = collections.Counter()
+    for name in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(name) as f:
+                lines = f.readlines()[1:]
+        except IOError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if int(fields[2].rsplit(':', 1)[1], 16) == port:
+                states[fields[3]] += 1
+    if not states:
+        return None, None
+    return states['01'], states['06']
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 1048576.0
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_threads(api, workload, stats, limiter, concurrency, stop):
+    def worker():
+        while not stop.is_set():
+            if limiter is not None:
+                limiter.acquire()
+            name, args, kwargs = workload.next_call()
+            start = time.time()
+            try:
+                result = getattr(api, name)(*args, **kwargs)
+            except Exception, e:
+                stats.record(name, time.time() - start, error=e)
+                continue
+            seconds = time.time() - start
+            stats.record(name, seconds, workload.finished(name, result))
+
+    workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    while not stop.is_set():
+        stop.wait(0.1)
+    for thread in workers:
+        thread.join()
+
+
+def run_async(api, workload, stats, limiter, max_in_flight, stop):
+    slots = threading.BoundedSemaphore(max_in_flight)
+    in_flight = {}
+    lock = threading.Lock()
+    submitted = threading.Event()
+
+    def collect():
+        while True:
+            with lock:
+                pending = in_flight.items()
+            if not pending:
+                if submitted.is_set():
+                    return
+                time.sleep(0.001)
+                continue
+            min(pending)[1][2].wait(0.001)
+            now = time.time()
+            for key, (name, start, result) in pending:
+                if not result.ready():
+                    continue
+                with lock:
+                    del in_flight[key]
+                slots.release()
+                try:
+                    value = result.get()
+                except Exception, e:
+                    stats.record(name, now - start, error=e)
+                    continue
+                stats.record(name, now - start,
+                             workload.finished(name, value))
+
+    collector = threading.Thread(target=collect)
+    collector.daemon = True
+    collector.start()
+    sequence = 0
+    while not stop.is_set():
+        if limiter is not None:
+            limiter.acquire()
+        slots.acquire()
+        name, args, kwargs = workload.next_call()
+        with lock:
+            in_flight[sequence] = (name, time.time(),
+                                   getattr(api, name)(*args, **kwargs))
+        sequence += 1
+    submitted.set()
+    collector.join()
+
+
+def report(stats, port, start, interval, stop, timeline):
+    print >> sys.stderr, '%7s %9s %8s %8s %8s %7s %9s %8s' % (
+        'elapsed', 'calls/s', 'p50 ms', 'p90 ms', 'p99 ms', 'conns',
+        'time_wait', 'rss MB')
+    last = start
+    while not stop.wait(interval):
+        now = time.time()
+        latencies = stats.take_interval()
+        established, time_wait = _tcp_connections(port) if port \
+            else (None, None)
+        point = {'elapsed': now - start,
+                 'throughput': len(latencies) / (now - last),
+                 'latency_ms': dict(
+                     ('p%d' % p, (percentile(latencies, p) or 0) * 1000)
+                     for p in PERCENTILES),
+                 'connections': established,
+                 'time_wait': time_wait,
+                 'rss_mb': _rss_mb()}
+        last = now
+        timeline.append(point)
+        print >> sys.stderr, '%7.1f %9.1f %8.1f %8.1f %8.1f %7s %9s %8.1f' % (
+            point['elapsed'], point['throughput'],
+            point['latency_ms']['p50'], point['latency_ms']['p90'],
+            point['latency_ms']['p99'],
+            '-' if established is None else established,
+            '-' if time_wait is None else time_wait, point['rss_mb'])
+
+
+def summary(stats, elapsed):
+    calls = {}
+    for name in sorted(stats.total):
+        latencies = sorted(stats.total[name])
+        calls[name] = dict(
+            [('count', stats.counts[name]),
+             ('failed', stats.failed[name]),
+             ('errors', stats.errors[name]),
+             ('throughput', stats.counts[name] / elapsed),
+             ('max_ms', stats.maximum[name] * 1000)] +
+            [('p%d_ms' % p, percentile(latencies, p) * 1000)
+             for p in PERCENTILES])
+    return calls
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to run')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='calls per second, 0 for as fast as possible')
+    parser.add_argument('--mix', type=parse_mix,
+                        default='pay=2,payment_details=5,payment_update=1,'
+                                'validate=2',
+                        help='relative weight per call')
+    parser.add_argument('--mode', choices=('threads', 'async'),
+                        default='threads')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='threads, or AsyncPaysonApi workers')
+    parser.add_argument('--max-in-flight', type=int,
+                        help='async calls submitted at most, by default '
+                             'twice the concurrency')
+    parser.add_argument('--transport', choices=('http', 'inprocess'),
+                        default='http')
+    parser.add_argument('--pool-size', type=int,
+                        help='idle connections kept, by default the '
+                             'concurrency')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the fake takes per request')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between report lines')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--output', help='write results as JSON to file')
+    args = parser.parse_args()
+
+    payson = payson_fake.FakePayson(latency=args.latency, jitter=args.jitter,
+                                    error_rate=args.error_rate,
+                                    seed=args.seed, max_payments=100000)
+    workload = Workload(payson, args.mix, args.seed)
+    server = None
+    port = None
+    kwargs = {}
+    if args.transport == 'http':
+        server = payson_fake.FakePaysonServer(payson).start()
+        port = urlparse.urlsplit(server.url).port
+        kwargs['endpoint'] = server.url
+        kwargs['pool'] = payson_api.ConnectionPool(
+            maxsize=args.pool_size or args.concurrency)
+    else:
+        kwargs['transport'] = payson_fake.FakePaysonTransport(payson)
+    if args.mode == 'async':
+        api = payson_api.AsyncPaysonApi(*USER, workers=args.concurrency,
+                                        **kwargs)
+    else:
+        api = payson_api.PaysonApi(*USER, **kwargs)
+    limiter = payson_api.RateLimiter(args.rate, burst=args.concurrency) \
+        if args.rate else None
+
+    stats = Stats(seed=args.seed)
+    stop = threading.Event()
+    timeline = []
+    start = time.time()
+    reporter = threading.Thread(target=report, args=(
+        stats, port, start, args.interval, stop, timeline))
+    reporter.daemon = True
+    reporter.start()
+    timer = threading.Timer(args.duration, stop.set)
+    timer.start()
+    try:
+        if args.mode == 'async':
+            run_async(api, workload, stats, limiter,
+                      args.max_in_flight or 2 * args.concurrency, stop)
+        else:
+            run_threads(api, workload, stats, limiter, args.concurrency,
+                        stop)
+    except KeyboardInterrupt:
+        stop.set()
+    finally:
+        timer.cancel()
+        elapsed = time.time() - start
+        reporter.join()
+        api.close()
+        if server is not None:
+            server.stop()
+
+    calls = summary(stats, elapsed)
+    print >> sys.stderr
+    print >> sys.stderr, '%-16s %8s %7s %7s %9s %8s %8s %8s %8s' % (
+        'call', 'count', 'failed', 'errors', 'calls/s', 'p50 ms', 'p90 ms',
+        'p99 ms', 'max ms')
+    for name, call in sorted(calls.items()):
+        print >> sys.stderr, \
+            '%-16s %8d %7d %7d %9.1f %8.1f %8.1f %8.1f %8.1f' % (
+                name, call['count'], call['failed'], call['errors'],
+                call['throughput'], call['p50_ms'], call['p90_ms'],
+                call['p99_ms'], call['max_ms'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'arguments': dict(vars(args)), 'calls': calls,
+                       'timeline': timeline,
+                       'connections_opened': kwargs['pool'].connections_opened
+                       if 'pool' in kwargs else None},
+                      f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Benchmark suite for the full request/response cycle.
+
+Times request encoding, response decoding, model construction,
+serialization and whole API calls against a local fake Payson, both
+in-process and over HTTP.
+Results are written as JSON, pass an earlier result file to --compare to
+see the change per case.
+
+    $ python benchmarks/run.py [--output result.json] [--compare old.json]
+                               [--filter NAME] [--repeat N] [--label L]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import timeit
+import urllib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixtures
+import payson_api
+import payson_fake
+
+USER = (payson_api.PAYSON_TEST_AGENT_ID[0], payson_api.PAYSON_TEST_AGENT_KEY[0])
+SIZES = (1, 10, 100)
+
+
+def encode_cases():
+    api = payson_api.PaysonApi(*USER, transport=fixtures.CannedTransport(
+        urllib.urlencode(fixtures.envelope() + [('TOKEN', 'x')])))
+    for items in SIZES:
+        request = fixtures.pay_request(items)
+        yield 'encode.pay', {'items': items}, lambda: api.pay(**request)
+
+
+def decode_cases():
+    for receivers in SIZES:
+        body = fixtures.payment_details_body(receivers, receivers)
+        yield ('decode.response', {'receivers': receivers,
+                                   'errors': receivers},
+               lambda: payson_api.decode_response(body))
+
+
+def model_cases():
+    for receivers in SIZES:
+        data = payson_api.decode_response(
+            fixtures.payment_details_body(receivers))
+
+        def construct():
+            payson_api.PaymentDetailsResponse(data).status
+
+        def full():
+            details = payson_api.PaymentDetailsResponse(data)
+            (details.status, details.guaranteeDeadlineTimestamp,
+             details.custom, details.trackingId, details.receiverFee,
+             details.amount, details.responseEnvelope.timestamp)
+
+        params = {'receivers': receivers}
+        yield 'model.payment_details.construct', params, construct
+        yield 'model.payment_details.full', params, full
+        yield ('model.receivers', params,
+               lambda: payson_api.Receiver.from_response_data(data))
+        errors = payson_api.decode_response(
+            fixtures.payment_details_body(0, receivers))
+        yield ('model.errors', {'errors': receivers},
+               lambda: payson_api.Error.from_response_dict(errors))
+
+
+def serialize_cases():
+    for receivers in SIZES:
+        details = payson_api.PaymentDetailsResponse(payson_api.decode_response(
+            fixtures.payment_details_body(receivers)))
+        data = details.to_bytes()
+        params = {'receivers': receivers}
+        yield 'serialize.to_bytes', params, details.to_bytes
+        yield ('serialize.from_bytes', params,
+               lambda: payson_api.PaymentDetailsResponse.from_bytes(data))
+
+
+def call_cases(kind, api, payson):
+    ipns = []
+    payson.ipn_handler = lambda url, message: ipns.append(message)
+    request = fixtures.pay_request(10)
+    request['ipnNotificationUrl'] = 'http://localhost/ipn'
+    token = api.pay(**request).token
+    payson.complete(token)
+    yield 'call.%s.pay' % kind, {'items': 10}, lambda: api.pay(**request)
+    yield ('call.%s.payment_details' % kind, {},
+           lambda: api.payment_details(token))
+    yield 'call.%s.validate' % kind, {}, lambda: api.validate(ipns[-1])
+
+
+def run_case(name, params, func, repeat):
+    # calibrate to roughly 0.2 seconds per repetition
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= 0.2 or number >= 100000:
+            break
+        number *= 10 if elapsed < 0.02 else 2
+    times = sorted(t / number for t in
+                   timeit.repeat(func, number=number, repeat=repeat))
+    return {'name': name,
+            'params': params,
+            'number': number,
+            'repeat': repeat,
+            'best_us': times[0] * 1e6,
+            'median_us': times[len(times) // 2] * 1e6}
+
+
+def case_key(result):
+    return result['name'], tuple(sorted(result['params'].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help='JSON file, default stdout')
+    parser.add_argument('--compare', help='earlier JSON result file')
+    parser.add_argument('--filter', default='',
+                        help='only run cases with names containing this')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--label', default='',
+                        help='e.g. the version or commit benchmarked')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = dict((case_key(r), r) for r in json.load(f)['results'])
+
+    payson = payson_fake.FakePayson()
+    in_process = payson_api.PaysonApi(
+        *USER, transport=payson_fake.FakePaysonTransport(payson))
+    server = payson_fake.FakePaysonServer().start()
+    over_http = payson_api.PaysonApi(*USER, endpoint=server.url)
+    suites = [encode_cases(), decode_cases(), model_cases(),
+              serialize_cases(),
+              call_cases('inprocess', in_process, payson),
+              call_cases('http', over_http, server.payson)]
+    results = []
+    try:
+        for suite in suites:
+            for name, params, func in suite:
+                if args.filter not in name:
+                    continue
+                result = run_case(name, params, func, args.repeat)
+                results.append(result)
+                line = '%-34s %-26s %12.1f us' % (
+                    name, ' '.join('%s=%s' % p for p in
+                                   sorted(params.items())),
+                    result['best_us'])
+                old = baseline.get(case_key(result))
+                if old:
+                    line += '  %5.2fx' % (old['best_us'] / result['best_us'])
+                print >> sys.stderr, line
+    finally:
+        over_http.close()
+        server.stop()
+
+    report = {'meta': {'label': args.label,
+                       'python': platform.python_version(),
+                       'implementation': platform.python_implementation(),
+                       'platform': platform.platform(),
+                       'date': datetime.datetime.utcnow().isoformat()},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+
+
+if __name__ == '__main__':
+    main()
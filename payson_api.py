@@ -4,15 +4,54 @@
 Copyright (c) 2012 Tomas Walch
 MIT-License, see LICENSE for details
 """
-import datetime
-import decimal
+import array
+import collections
+import cStringIO
+import functools
+import hashlib
+import heapq
+import httplib
+import itertools
 import logging
-import json
+import marshal
+import os
+import Queue
+import random
+import select
+import socket
+import threading
+import time
 import urllib
 import urllib2
 import urlparse
 
 
+class _LazyModule(object):
+    """Placeholder for a module that is not needed to import this one.
+
+    The module is imported on first attribute access and then takes the
+    place of the placeholder in the module globals, so later uses cost
+    nothing extra.
+    """
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        module = __import__(self._name)
+        globals()[self._name.split('.')[0]] = module
+        return getattr(module, attr)
+
+
+# Only needed once calls are made, together they take longer to import than
+# the rest of this module
+csv = _LazyModule('csv')
+datetime = _LazyModule('datetime')
+decimal = _LazyModule('decimal')
+inspect = _LazyModule('inspect')
+json = _LazyModule('json')
+multiprocessing = _LazyModule('multiprocessing.pool')
+
+
 PAYSON_API_ENDPOINT = "https://api.payson.se"
 PAYSON_TEST_API_ENDPOINT = "https://test-api.payson.se"
 PAYSON_API_VERSION = "1.0"
@@ -27,208 +66,2789 @@ PAYSON_TEST_AGENT_ID = ('1', '4')
 PAYSON_TEST_AGENT_KEY = ('fddb19ac-7470-42b6-a91d-072cb1495f0a',
                          '2acab30d-fe50-426f-90d7-8c60a7eb31d4')
 
-log = logging.getLogger('Payson API')
+PAYSON_TERMINAL_STATUSES = ('COMPLETED', 'CREDITED', 'ERROR',
+                            'REVERSALERROR', 'ABORTED')
+
+log = logging.getLogger('Payson API')
+
+_EndpointCommands = collections.namedtuple(
+    '_EndpointCommands', 'pay payment_details payment_update validate send_ipn')
+_endpoint_commands = {}
+
+
+def _commands(endpoint):
+    """Command URLs of endpoint, built once and shared by all instances."""
+    commands = _endpoint_commands.get(endpoint)
+    if commands is None:
+        def mkcmd(cmd):
+            return '/'.join((endpoint, PAYSON_API_VERSION, cmd))
+
+        commands = _endpoint_commands[endpoint] = _EndpointCommands(
+            mkcmd(PAYSON_API_PAY_ACTION),
+            mkcmd(PAYSON_API_PAYMENT_DETAILS_ACTION),
+            mkcmd(PAYSON_API_PAYMENT_UPDATE_ACTION),
+            mkcmd(PAYSON_API_VALIDATE_ACTION),
+            mkcmd('SendIPN/'))
+    return commands
+
+
+_commands(PAYSON_API_ENDPOINT)
+_commands(PAYSON_TEST_API_ENDPOINT)
+
+
+def _imap_unordered(func, iterable, max_concurrency):
+    """Call func for each item in iterable using max_concurrency threads.
+
+    Yields (item, result, exception) tuples in order of completion, where
+    exception is None unless func raised one. Items are pulled lazily from 
+    iterable and only a few more than max_concurrency are held at a time, 
+    so it may be very long.
+    """
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+    slots = threading.Semaphore(2 * max_concurrency)
+    stop = threading.Event()
+    done = object()
+    feed_error = []
+
+    def feed():
+        try:
+            for item in iterable:
+                slots.acquire()
+                if stop.is_set():
+                    break
+                tasks.put(item)
+        except Exception, e:
+            feed_error.append(e)
+        finally:
+            for _ in range(max_concurrency):
+                tasks.put(done)
+
+    def work():
+        while True:
+            item = tasks.get()
+            if item is done:
+                results.put(done)
+                return
+            if stop.is_set():
+                continue
+            try:
+                results.put((item, func(item), None))
+            except Exception, e:
+                results.put((item, None, e))
+
+    threads = [threading.Thread(target=feed)]
+    threads.extend(threading.Thread(target=work)
+                   for _ in range(max_concurrency))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        finished = 0
+        while finished < max_concurrency:
+            result = results.get()
+            if result is done:
+                finished += 1
+                continue
+            slots.release()
+            yield result
+        if feed_error:
+            raise feed_error[0]
+    finally:
+        stop.set()
+        for _ in range(2 * max_concurrency):
+            slots.release()
+
+
+def _imap_ordered(func, iterable, max_concurrency):
+    """Like _imap_unordered, but yields in the order of iterable.
+
+    Calls are started as long as no more than 2 * max_concurrency results 
+    are outstanding, a slow call holds back the following results.
+    """
+    executor = multiprocessing.pool.ThreadPool(max_concurrency)
+    pending = collections.deque()
+
+    def result():
+        item, async_result = pending.popleft()
+        try:
+            return item, async_result.get(), None
+        except Exception, e:
+            return item, None, e
+
+    try:
+        for item in iterable:
+            pending.append((item, executor.apply_async(func, (item, ))))
+            if len(pending) >= 2 * max_concurrency:
+                yield result()
+        while pending:
+            yield result()
+    finally:
+        executor.terminate()
+
+
+def _is_dropped(conn):
+    """Whether the server closed idle connection conn.
+
+    An idle connection has nothing to read unless the server closed it, or 
+    broke the protocol, either way it cannot be used.
+    """
+    if conn.sock is None:
+        return True
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+class ConnectionPool(object):
+    """Thread safe pool of persistent HTTP(S) connections.
+
+    Idle connections are kept per (scheme, host, port) and reused by the
+    following requests, which saves a TCP and TLS handshake per API call.
+    """
+    connection_classes = {'http': httplib.HTTPConnection,
+                          'https': httplib.HTTPSConnection}
+
+    def __init__(self, maxsize=10, idle_timeout=60, timeout=None):
+        """Constructor
+
+        :param maxsize: Max number of idle connections kept per host
+        :type maxsize: int
+        :param idle_timeout: Seconds an idle connection may be reused
+        :type idle_timeout: float
+        :param timeout: Socket timeout in seconds, None for no timeout
+        :type timeout: float
+        """
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.connections_opened = 0
+
+    def urlopen(self, method, url, body=None, headers=None, timings=None,
+                timeout=None):
+        """Make a request over a pooled connection.
+
+        A reused connection may have been closed by the server while idle. 
+        Such connections are dropped before use, and if sending the request 
+        still fails on one it is sent on a fresh connection. Once the 
+        request has been sent it is never sent again, the server may have 
+        acted on it.
+
+        :param timings: If given, seconds spent to 'connect', 'send' and 
+                        'wait' for the response are stored in it
+        :type timings: dict
+        :param timeout: Socket timeout for this request in place of the 
+                        timeout of the pool
+        :type timeout: float
+        :returns: response and response body
+        :rtype: (httplib.HTTPResponse, str)
+        """
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        while True:
+            conn, reused = self._get(key)
+            try:
+                if timeout is not None:
+                    conn.timeout = timeout
+                    if reused:
+                        conn.sock.settimeout(timeout)
+                start = connected = time.time()
+                sent = None
+                if not reused:
+                    conn.connect()
+                    connected = time.time()
+                conn.request(method, path, body, headers or {})
+                sent = time.time()
+                response = conn.getresponse()
+                data = response.read()
+            except socket.timeout:
+                # no second try, it would double the time spent
+                conn.close()
+                raise
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if reused and sent is None:
+                    continue
+                raise
+            if timeout is not None:
+                conn.timeout = self.timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(self.timeout)
+            if timings is not None:
+                timings['connect'] = connected - start
+                timings['send'] = sent - connected
+                timings['wait'] = time.time() - sent
+            if response.will_close:
+                conn.close()
+            else:
+                self._put(key, conn)
+            return response, data
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, _ in connections:
+                conn.close()
+
+    def _get(self, key):
+        now = time.time()
+        expired = []
+        conn = None
+        with self._lock:
+            connections = self._idle.get(key, [])
+            while connections:
+                candidate, last_used = connections.pop()
+                if (now - last_used < self.idle_timeout and
+                        not _is_dropped(candidate)):
+                    conn = candidate
+                    break
+                expired.append(candidate)
+        for candidate in expired:
+            candidate.close()
+        if conn is not None:
+            return conn, True
+        scheme, host, port = key
+        conn = self.connection_classes[scheme](host, port,
+                                               timeout=self.timeout)
+        self.connections_opened += 1
+        return conn, False
+
+    def _put(self, key, conn):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.maxsize:
+                connections.append((conn, time.time()))
+                return
+        conn.close()
+
+
+class Transport(object):
+    """Sends requests to Payson.
+
+    Pass an instance to PaysonApi to change how requests are sent. The 
+    default is a PooledTransport.
+    """
+    def send(self, url, body, headers, timings=None, timeout=None):
+        """POST body to url.
+
+        timings and timeout are passed as keyword arguments, and only to 
+        transports taking them, send(url, body, headers) is enough. Without
+        timeout a request cannot be cut short when its deadline runs out.
+
+        :type url: str
+        :type body: str
+        :type headers: dict
+        :param timings: If given, store the seconds spent in the phases 
+                        'connect', 'send' and 'wait' that can be measured
+        :type timings: dict
+        :param timeout: Socket timeout in seconds for this request, by 
+                        default the timeout of the transport
+        :type timeout: float
+        :returns: response body
+        :rtype: str
+        :raises urllib2.URLError: if the request fails, urllib2.HTTPError 
+                                  for non 2xx responses
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release any resources held."""
+        pass
+
+
+_send_arguments = {}
+
+
+def _send_options(transport, timings, timeout):
+    """Keyword arguments of transport.send for timings and timeout.
+
+    Transports written for send(url, body, headers) get neither.
+    """
+    cls = type(transport)
+    accepted = _send_arguments.get(cls)
+    if accepted is None:
+        try:
+            args, _, keywords, _ = inspect.getargspec(transport.send)
+        except TypeError:
+            args, keywords = (), None
+        accepted = _send_arguments[cls] = frozenset(
+            name for name in ('timings', 'timeout')
+            if keywords is not None or name in args)
+    options = {}
+    if timings is not None and 'timings' in accepted:
+        options['timings'] = timings
+    if timeout is not None and 'timeout' in accepted:
+        options['timeout'] = timeout
+    return options
+
+
+class PooledTransport(Transport):
+    """Sends requests over keep-alive connections from a ConnectionPool."""
+
+    def __init__(self, pool=None):
+        self.pool = pool if pool is not None else ConnectionPool()
+
+    def send(self, url, body, headers, timings=None, timeout=None):
+        try:
+            response, data = self.pool.urlopen('POST', url, body, headers,
+                                               timings, timeout)
+        except (socket.error, httplib.HTTPException), e:
+            raise urllib2.URLError(e)
+        if not 200 <= response.status < 300:
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, cStringIO.StringIO(data))
+        return data
+
+    def close(self):
+        self.pool.close()
+
+
+class UrllibTransport(Transport):
+    """Sends every request on a new connection through urllib2."""
+
+    def __init__(self, timeout=None, context=None):
+        """Constructor
+
+        :param timeout: Socket timeout in seconds, None for no timeout
+        :type timeout: float
+        :param context: SSL context for HTTPS connections
+        :type context: ssl.SSLContext
+        """
+        self.timeout = timeout
+        self.context = context
+
+    def send(self, url, body, headers, timings=None, timeout=None):
+        request = urllib2.Request(url, body, headers)
+        kwargs = {'context': self.context} if self.context else {}
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        start = time.time()
+        data = urllib2.urlopen(request, **kwargs).read()
+        if timings is not None:
+            timings['wait'] = time.time() - start
+        return data
+
+
+class DeadlineExceeded(urllib2.URLError):
+    """The time budget of a call ran out before Payson answered."""
+
+    def __init__(self, url):
+        urllib2.URLError.__init__(self, 'deadline exceeded calling %s' % url)
+
+
+class CircuitOpenError(urllib2.URLError):
+    """A CircuitBreaker rejected the call without sending it."""
+
+    def __init__(self, url):
+        urllib2.URLError.__init__(self, 'circuit open, not calling %s' % url)
+
+
+def _is_transient(error):
+    """True if error may well not happen again when the call is repeated."""
+    if isinstance(error, (DeadlineExceeded, CircuitOpenError)):
+        return False
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500
+    return isinstance(error, urllib2.URLError)
+
+
+class RetryPolicy(object):
+    """Retries of idempotent calls, PaymentDetails and Validate.
+
+    Waits between attempts grow exponentially and are jittered over
+    [0, backoff * 2 ** attempt] so that many clients do not retry in step.
+    """
+    def __init__(self, attempts=3, backoff=0.1, max_backoff=2.0, seed=None):
+        """Constructor
+
+        :param attempts: Max number of attempts, including the first
+        :type attempts: int
+        :param backoff: Max seconds to wait before the first retry
+        :type backoff: float
+        :param max_backoff: Max seconds to wait before any retry
+        :type max_backoff: float
+        """
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retries = 0
+        self._random = random.Random(seed)
+
+    def delay(self, attempt, error):
+        """Seconds to wait before repeating a call failing with error.
+
+        :param attempt: Number of attempts made so far
+        :type attempt: int
+        :returns: None if the call should not be repeated
+        :rtype: float
+        """
+        if attempt >= self.attempts or not _is_transient(error):
+            return None
+        self.retries += 1
+        return self._random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+
+class RateLimiter(object):
+    """Token bucket letting through rate calls per second on average.
+
+    Up to burst calls may pass at once after a quiet period. Thread safe, 
+    so one limiter can be shared by many threads.
+    """
+    def __init__(self, rate, burst=1):
+        """Constructor
+
+        :param rate: Calls per second
+        :type rate: float
+        :param burst: Max calls let through at once
+        :type burst: int
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a call may be made."""
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class _Semaphore(object):
+    """Semaphore whose acquire can give up at a deadline.
+
+    threading.Semaphore.acquire takes no timeout in Python 2.
+    """
+    def __init__(self, value):
+        self._value = value
+        self._condition = threading.Condition(threading.Lock())
+
+    def acquire(self, deadline=None):
+        """Take a slot, waiting until time.time() reaches deadline.
+
+        :returns: False if no slot was free before deadline
+        :rtype: bool
+        """
+        with self._condition:
+            while not self._value:
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self._value -= 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self._value += 1
+            self._condition.notify()
+
+
+class CircuitBreaker(object):
+    """Fails calls fast while Payson seems to be down.
+
+    After failure_threshold failures in a row the circuit opens and calls 
+    raise CircuitOpenError at once. After reset_timeout seconds one call is
+    let through, the circuit closes again if it succeeds. Only transient 
+    errors count as failures, an HTTP 4xx means Payson is answering.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        """Constructor
+
+        :param failure_threshold: Failures in a row that open the circuit
+        :type failure_threshold: int
+        :param reset_timeout: Seconds before a call is tried again
+        :type reset_timeout: float
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.rejected = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """'closed', 'open' or 'half-open'"""
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            if (self._trial or
+                    time.time() - self.opened_at >= self.reset_timeout):
+                return 'half-open'
+            return 'open'
+
+    def before_call(self, url):
+        """:raises CircuitOpenError: if the call should not be made"""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if (not self._trial and
+                    time.time() - self.opened_at >= self.reset_timeout):
+                self._trial = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(url)
+
+    def record(self, error=None):
+        """Report the outcome of a call let through by before_call."""
+        with self._lock:
+            if error is None or not _is_transient(error):
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self._trial or self.failures >= self.failure_threshold:
+                    if self.opened_at is None:
+                        log.warning('PAYSON: Circuit opened after %d '
+                                    'failures', self.failures)
+                    self.opened_at = time.time()
+            self._trial = False
+
+
+class HedgePolicy(object):
+    """When to send a second payment_details request for the same token.
+
+    If the first request has not been answered after the given percentile
+    of recent response times, a second one is sent and the first answer 
+    wins. Response times of all successful requests are kept, also of 
+    those that lost to a hedge. Until min_samples response times are known 
+    initial_delay is used.
+    """
+    def __init__(self, percentile=95, initial_delay=1.0, min_delay=0.01,
+                 window=200, min_samples=20):
+        """Constructor
+
+        :param percentile: Percentile of response times to wait for
+        :type percentile: float
+        :param initial_delay: Seconds to wait while there are few samples
+        :type initial_delay: float
+        :param min_delay: Never hedge sooner than this
+        :type min_delay: float
+        :param window: Number of recent response times kept
+        :type window: int
+        :param min_samples: Samples needed before the percentile is used
+        :type min_samples: int
+        """
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.hedges = 0
+        self._samples = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def delay(self):
+        """Seconds to wait for the first request before hedging."""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return self.initial_delay
+            samples = sorted(self._samples)
+        index = int(round(self.percentile / 100.0 * (len(samples) - 1)))
+        return max(self.min_delay, samples[index])
+
+
+class CallEvent(object):
+    """A call to the Payson API, as reported to listeners.
+
+    timings holds the seconds spent to 'connect' (zero for a reused 
+    connection), 'send' the request, 'wait' for the response and 'parse'
+    it, as far as the transport measures them. ack is the responseEnvelope
+    ack, or the response of validate, and error_ids the errorIds of the
+    responseEnvelope errorList. If the call failed, exception is set.
+    """
+    def __init__(self, url, request):
+        self.url = url
+        self.action = url.rstrip('/').rsplit('/', 1)[-1]
+        self.request_size = len(request)
+        self.response_size = None
+        self.timings = {}
+        self.ack = None
+        self.error_ids = []
+        self.exception = None
+        self.started = time.time()
+        self.duration = None
+
+
+class CallListener(object):
+    """Base for listeners added with PaysonApi.add_listener.
+
+    Override the methods needed, for instance to update metrics or start 
+    and end tracing spans. Listeners are called from the thread making the
+    call and exceptions they raise are logged and ignored.
+    """
+    def call_started(self, event):
+        """Called before sending the request.
+
+        :type event: CallEvent
+        """
+        pass
+
+    def call_finished(self, event):
+        """Called when the call has succeeded or failed.
+
+        :type event: CallEvent
+        """
+        pass
+
+
+class _Histogram(object):
+    """Counts of observed values per bucket, as in Prometheus."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def as_dict(self):
+        return {'buckets': dict(zip(self.buckets, self.counts)),
+                'count': self.count,
+                'sum': self.sum}
+
+
+class MetricsListener(CallListener):
+    """Keeps Prometheus style counters and histograms of API calls.
+
+    calls counts calls per (action, outcome), where outcome is the ack or
+    the exception class name, and errors counts (action, errorId) pairs. 
+    Histograms of seconds per (action, phase) are kept in latency, with the
+    phase 'total' for the whole call, and of response bytes per action in
+    response_size.
+    """
+    latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                       5.0, 10.0, float('inf'))
+    size_buckets = (256, 1024, 4096, 16384, 65536, float('inf'))
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.errors = collections.Counter()
+        self.latency = {}
+        self.response_size = {}
+        self._lock = threading.Lock()
+
+    def call_finished(self, event):
+        action = event.action
+        if event.exception is not None:
+            outcome = type(event.exception).__name__
+        else:
+            outcome = event.ack
+        with self._lock:
+            self.calls[action, outcome] += 1
+            for error_id in event.error_ids:
+                self.errors[action, error_id] += 1
+            phases = dict(event.timings, total=event.duration)
+            for phase, seconds in phases.iteritems():
+                self._histogram(self.latency, (action, phase),
+                                self.latency_buckets).observe(seconds)
+            if event.response_size is not None:
+                self._histogram(self.response_size, action,
+                                self.size_buckets).observe(
+                                    event.response_size)
+
+    def snapshot(self):
+        """All metrics as a dict of plain values."""
+        with self._lock:
+            return {'calls': dict(self.calls),
+                    'errors': dict(self.errors),
+                    'latency': dict((key, histogram.as_dict())
+                                    for key, histogram
+                                    in self.latency.iteritems()),
+                    'response_size': dict((key, histogram.as_dict())
+                                          for key, histogram
+                                          in self.response_size.iteritems())}
+
+    @staticmethod
+    def _histogram(histograms, key, buckets):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = _Histogram(buckets)
+        return histogram
+
+
+class _TtlLruCache(object):
+    """Thread safe mapping bounded both in size and age of entries.
+
+    The least recently used entry is evicted when maxsize is exceeded and
+    entries older than their time to live are treated as missing.
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[1] > time.time():
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def _set(self, key, value, ttl=None):
+        # with self._lock held
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        self._entries.pop(key, None)
+        self._entries[key] = (value, expires)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_ratio(self):
+        """Share of lookups answered from the cache."""
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+
+class PaymentDetailsCache(_TtlLruCache):
+    """Cache of payment_details responses keyed by token.
+
+    Payments in one of PAYSON_TERMINAL_STATUSES are not expected to change
+    and are kept for terminal_ttl seconds instead of ttl. PaysonApi drops the
+    entry for a token when it is updated through payment_update or when a
+    verified IPN for it is validated.
+
+    Cached PaymentDetailsResponse instances are shared between callers and
+    should not be modified.
+    """
+    def __init__(self, maxsize=1000, ttl=10, terminal_ttl=300):
+        """Constructor
+
+        :param maxsize: Max number of cached payments
+        :type maxsize: int
+        :param ttl: Seconds to cache payments that may still change
+        :type ttl: float
+        :param terminal_ttl: Seconds to cache payments in a terminal status
+        :type terminal_ttl: float
+        """
+        super(PaymentDetailsCache, self).__init__(maxsize, ttl)
+        self.terminal_ttl = terminal_ttl
+        self.invalidations = 0
+        # token -> value of invalidations when it was last invalidated, the
+        # oldest are forgotten and then treated as invalidated at _forgotten
+        self._invalidated = collections.OrderedDict()
+        self._forgotten = 0
+
+    def put(self, token, details, invalidations):
+        """Cache details for token.
+
+        Nothing is cached for failed requests or if token has been 
+        invalidated since invalidations was read, as details may be stale.
+        """
+        if not details.success:
+            return
+        ttl = self.terminal_ttl \
+            if details.status in PAYSON_TERMINAL_STATUSES else self.ttl
+        with self._lock:
+            if self._invalidated.get(token, self._forgotten) > invalidations:
+                return
+            self._set(token, details, ttl)
+
+    def invalidate(self, token):
+        """Drop cached details for token."""
+        with self._lock:
+            self.invalidations += 1
+            self._entries.pop(token, None)
+            self._invalidated.pop(token, None)
+            self._invalidated[token] = self.invalidations
+            while len(self._invalidated) > self.maxsize:
+                self._forgotten = self._invalidated.popitem(last=False)[1]
+
+
+class _Flight(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class PayCoalescer(_TtlLruCache):
+    """Makes pay idempotent per trackingId or idempotency_key.
+
+    Concurrent pay calls with the same key and the same arguments share one 
+    request, and the PayResponse of a successful one is returned again for 
+    window seconds without calling Payson, so double clicks and client 
+    retries get the same token and forward_pay_url. Calls with the same key
+    but other arguments, e.g. another amount, are separate payments. Failed 
+    calls are not remembered.
+    """
+    def __init__(self, window=600, maxsize=10000, wait_timeout=60):
+        """Constructor
+
+        :param window: Seconds a successful PayResponse is reused
+        :type window: float
+        :param maxsize: Max number of PayResponses kept
+        :type maxsize: int
+        :param wait_timeout: Max seconds to wait for an ongoing call with 
+                             the same key, for calls without a deadline
+        :type wait_timeout: float
+        """
+        super(PayCoalescer, self).__init__(maxsize, window)
+        self.wait_timeout = wait_timeout
+        self.coalesced = 0
+        self._in_flight = {}
+
+    def call(self, key, pay, deadline=None):
+        """Return pay(), or the result of an earlier or ongoing call for key.
+
+        :param deadline: time.time() by which to give up waiting for an 
+                         ongoing call
+        :type deadline: float
+        :raises DeadlineExceeded: if the ongoing call does not finish in time
+        """
+        response = self.get(key)
+        if response is not None:
+            return response
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                return entry[0]
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            timeout = deadline - time.time() if deadline is not None \
+                else self.wait_timeout
+            if not flight.done.wait(max(timeout, 0)):
+                raise DeadlineExceeded('pay for %r' % (key, ))
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = pay()
+            if flight.result.success:
+                self.set(key, flight.result)
+            return flight.result
+        except Exception, e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            flight.done.set()
+
+
+class _FormEncoder(object):
+    """Writes an application/x-www-form-urlencoded body field by field.
+
+    Gives the same fields as urllib.urlencode, in the order they are added.
+    Quoted names of indexed fields, like receiverList.receiver(0).email, are
+    cached per list and index as they repeat between requests.
+    """
+    _prefixes = {}
+
+    def __init__(self):
+        self.parts = []
+
+    def add(self, key, value):
+        """Add a field, key must not need quoting and value must be a str.
+        """
+        self.parts.append(key + '=' + urllib.quote_plus(value))
+
+    def add_indexed(self, name, index, key, value):
+        """Add the field name(index).key"""
+        try:
+            prefix = self._prefixes[name, index]
+        except KeyError:
+            prefix = self._prefixes[name, index] = \
+                urllib.quote_plus('%s(%d).' % (name, index))
+        self.parts.append(prefix + key + '=' + urllib.quote_plus(value))
+
+    def getvalue(self):
+        return '&'.join(self.parts)
+
+
+PaymentUpdateResult = collections.namedtuple(
+    'PaymentUpdateResult', 'token action ack errorList attempts exception')
+
+# status, or invoiceStatus for invoices, after a successful payment_update
+_PAYMENT_UPDATE_STATES = {'SHIPORDER': 'SHIPPED',
+                          'CANCELORDER': 'CANCELED',
+                          'CREDITORDER': 'CREDITED',
+                          'REFUND': 'CREDITED'}
+
+
+class PaysonApi():
+
+    def __init__(self, user_id, user_key, pool=None, cache=None,
+                 transport=None, endpoint=None, timeout=None, retry=None,
+                 circuit_breaker=None, hedge=None, max_concurrency=None,
+                 pay_coalescer=None, keep_raw=False):
+        """Constructor
+
+        :param user_id: Agent ID obtained from Payson
+        :type user_id: str
+        :param user_key: Password (MD5 Key) obtained from Payson
+        :type user_key: str
+        :param pool: Connection pool for the default transport, by default
+                     one is created for this instance
+        :type pool: ConnectionPool
+        :param cache: Optional cache for payment_details responses
+        :type cache: PaymentDetailsCache
+        :param transport: How requests are sent, by default a 
+                          PooledTransport using pool
+        :type transport: Transport
+        :param endpoint: API endpoint URL, by default the live or test 
+                         endpoint depending on user_id and user_key
+        :type endpoint: str
+        :param timeout: Default time budget in seconds for a call, 
+                        including retries, None for no limit
+        :type timeout: float
+        :param retry: Retries of failing payment_details and validate calls
+        :type retry: RetryPolicy
+        :param circuit_breaker: Fail fast while Payson seems to be down
+        :type circuit_breaker: CircuitBreaker
+        :param hedge: Send slow payment_details requests twice
+        :type hedge: HedgePolicy
+        :param max_concurrency: Max number of requests in flight at the 
+                                same time, None for no limit
+        :type max_concurrency: int
+        :param pay_coalescer: Makes pay idempotent per trackingId
+        :type pay_coalescer: PayCoalescer
+        :param keep_raw: Read responses through RawResponseData, keeping 
+                         the raw body in place of a dict of fields
+        :type keep_raw: bool
+        """
+        if (user_id in PAYSON_TEST_AGENT_ID and
+            user_key in PAYSON_TEST_AGENT_KEY):
+            default_endpoint = PAYSON_TEST_API_ENDPOINT
+            self.forward_pay_url = PAYSON_WWW_PAY_FORWARD_TEST_URL
+        else:
+            default_endpoint = PAYSON_API_ENDPOINT
+            self.forward_pay_url = PAYSON_WWW_PAY_FORWARD_URL
+        endpoint = endpoint or default_endpoint
+
+        self.user_id = user_id
+        self.user_key = user_key
+        self.transport = transport if transport is not None \
+            else PooledTransport(pool)
+        self.cache = cache
+        self.timeout = timeout
+        self.retry = retry
+        self.circuit_breaker = circuit_breaker
+        self.hedge = hedge
+        self.pay_coalescer = pay_coalescer
+        self.keep_raw = keep_raw
+        self.listeners = []
+        self._slots = _Semaphore(max_concurrency) \
+            if max_concurrency is not None else None
+        self._headers = {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'PAYSON-SECURITY-USERID': user_id,
+            'PAYSON-SECURITY-PASSWORD': user_key}
+
+        commands = _commands(endpoint)
+        self.pay_cmd = commands.pay
+        self.get_payment_details_cmd = commands.payment_details
+        self.update_payment_details_cmd = commands.payment_update
+        self.validate_ipn_cmd = commands.validate
+        self.send_ipn_cmd = commands.send_ipn
+
+    def pay(self,
+            returnUrl,
+            cancelUrl,
+            memo,
+            senderEmail,
+            senderFirstName,
+            senderLastName,
+            receiverList,
+            ipnNotificationUrl=None,
+            localeCode=None,
+            currencyCode=None,
+            fundingList=tuple(),
+            feesPayer=None,
+            invoiceFee=None,
+            custom=None,
+            trackingId=None,
+            guaranteeOffered=None,
+            orderItemList=tuple(),
+            showReceiptPage=True,
+            idempotency_key=None):
+        """The starting point for any kind of payment.
+
+        For a longer description, including possible parameter values and 
+        constraints, see https://api.payson.se/#Initializepayment
+
+        :type returnUrl: unicode
+        :type cancelUrl: unicode
+        :type memo: unicode
+        :type senderEmail: unicode
+        :type senderFirstName: unicode
+        :type senderLastName: unicode
+        :type receiverList: iterable of Receiver instances
+        :type ipnNotificationUrl: unicode
+        :type localeCode: unicode
+        :type currencyCode: unicode
+        :type fundingList: iterable with unicode instances
+        :type feesPayer: unicode
+        :type invoiceFee: decimal.Decimal
+        :type custom: any json serializable Python object
+        :type trackingId: unicode or int
+        :type guaranteeOffered: unicode
+        :type orderItemList: iterable of OrderItem instances
+        :type showReceiptPage: bool
+        :param idempotency_key: With a pay_coalescer, calls with the same 
+                                key and arguments get the same response, 
+                                by default trackingId is used
+        :rtype: PayResponse
+        :raises DeadlineExceeded: if self.timeout runs out
+        """
+        request = _FormEncoder()
+        add, add_indexed = request.add, request.add_indexed
+        add('returnUrl', str(returnUrl))
+        add('cancelUrl', str(cancelUrl))
+        add('memo', memo.encode('utf-8'))
+        add('senderEmail', senderEmail.encode('utf-8'))
+        add('senderFirstName', senderFirstName.encode('utf-8'))
+        add('senderLastName', senderLastName.encode('utf-8'))
+        for i, v in enumerate(receiverList):
+            k = 'receiverList.receiver'
+            add_indexed(k, i, 'email', v.email.encode('utf-8'))
+            add_indexed(k, i, 'amount', str(v.amount))
+            if v.primary is not None:
+                add_indexed(k, i, 'primary', json.dumps(v.primary))
+            if v.firstName:
+                add_indexed(k, i, 'firstName', v.firstName.encode('utf-8'))
+            if v.lastName:
+                add_indexed(k, i, 'lastName', v.lastName.encode('utf-8'))
+        if ipnNotificationUrl:
+            add('ipnNotificationUrl', str(ipnNotificationUrl))
+        if localeCode:
+            add('localeCode', str(localeCode))
+        if currencyCode:
+            add('currencyCode', str(currencyCode))
+        for i, v in enumerate(fundingList):
+            add_indexed('fundingList.fundingConstraint', i, 'constraint',
+                        str(v))
+        if feesPayer:
+            add('feesPayer', str(feesPayer))
+        if invoiceFee is not None:
+            add('invoiceFee', str(invoiceFee))
+        if custom is not None:
+            add('custom', json.dumps(custom))
+        if trackingId is not None:
+            add('trackingId', trackingId.encode('utf-8'))
+        if guaranteeOffered:
+            add('guaranteeOffered', str(guaranteeOffered))
+        for i, v in enumerate(orderItemList):
+            k = 'orderItemList.orderItem'
+            add_indexed(k, i, 'description', v.description.encode('utf-8'))
+            add_indexed(k, i, 'sku', str(v.sku))
+            add_indexed(k, i, 'quantity', str(v.quantity))
+            add_indexed(k, i, 'unitPrice', str(v.unitPrice))
+            add_indexed(k, i, 'taxPercentage', str(v.taxPercentage))
+        if showReceiptPage is False:
+            add('showReceiptPage', json.dumps(showReceiptPage))
+        deadline = self._deadline()
+        query = request.getvalue()
+        call = functools.partial(
+            self._call, self.pay_cmd, query,
+            lambda body: PayResponse(self.forward_pay_url,
+                                     self._decode(self.pay_cmd, body)),
+            deadline)
+        if idempotency_key is None:
+            idempotency_key = trackingId
+        if self.pay_coalescer is None or idempotency_key is None:
+            return call()
+        # a different request under the same key is a different payment
+        key = (self.user_id, idempotency_key, hashlib.sha1(query).digest())
+        return self.pay_coalescer.call(key, call, deadline)
+
+    def payment_details(self, token, timeout=None):
+        """Get details about an existing payment.
+
+        For a longer description, including possible parameter values, see 
+        https://api.payson.se/#PaymentDetailsrequest
+
+        :type token: unicode
+        :param timeout: Time budget in seconds in place of self.timeout
+        :type timeout: float
+        :rtype: PaymentDetailsResponse
+        :raises DeadlineExceeded: if the time budget runs out
+        """
+        if self.cache is not None:
+            payment_details_response = self.cache.get(token)
+            if payment_details_response is not None:
+                return payment_details_response
+            invalidations = self.cache.invalidations
+        cmd = self.get_payment_details_cmd
+        call = functools.partial(
+            self._call, cmd, urllib.urlencode({'token': token}),
+            lambda body: PaymentDetailsResponse(self._decode(cmd, body)),
+            self._deadline(timeout), True)
+        if self.hedge is not None:
+            payment_details_response = self._hedged(call)
+        else:
+            payment_details_response = call()
+        if self.cache is not None:
+            self.cache.put(token, payment_details_response, invalidations)
+        return payment_details_response
+
+    def payment_details_many(self, tokens, max_concurrency=10):
+        """Get details about many existing payments concurrently.
+
+        Results are yielded as soon as they arrive, a failing lookup does not
+        affect the others but yields the exception in place of the details.
+
+        :type tokens: iterable of unicode
+        :param max_concurrency: Max number of requests in flight
+        :type max_concurrency: int
+        :returns: (token, PaymentDetailsResponse or exception) tuples
+        :rtype: generator
+        """
+        lookup = self.payment_details
+        for token, details, error in _imap_unordered(lookup, tokens,
+                                                     max_concurrency):
+            yield token, details if error is None else error
+
+    def payment_update(self, token, action):
+        """Update an existing payment, for instance mark an order as shipped or canceled. 
+
+        For a longer description, including possible parameter values, see 
+        https://api.payson.se/#PaymentUpdaterequest
+
+        :type token: unicode
+        :type action: unicode
+        :returns: True if the update succeeded
+        :rtype: bool
+        """
+        return self._payment_update(token, action).ack == 'SUCCESS'
+
+    def payment_update_many(self, updates, max_concurrency=10, rate=None,
+                            retry=None, progress=None, progress_every=100):
+        """Update many payments concurrently, e.g. ship a day of orders.
+
+        Requests failing with a transient error are retried according to 
+        retry, but only after payment_details shows that the update was not 
+        applied already. When that cannot be checked, the result holds the 
+        exception of the failed request and the update is not sent again.
+        Results are yielded as they arrive.
+
+        :param updates: (token, action) tuples
+        :type updates: iterable
+        :param max_concurrency: Max number of requests in flight
+        :type max_concurrency: int
+        :param rate: Max requests per second, or a RateLimiter to share
+        :type rate: float
+        :param retry: By default 3 attempts
+        :type retry: RetryPolicy
+        :param progress: Called with a dict of counters and throughput 
+                         every progress_every results and at the end
+        :rtype: generator of PaymentUpdateResult
+        """
+        if rate is not None and not isinstance(rate, RateLimiter):
+            rate = RateLimiter(rate)
+        if retry is None:
+            retry = RetryPolicy()
+        update = functools.partial(self._update_with_retries,
+                                   retry=retry, limiter=rate)
+        counters = collections.Counter()
+        start = time.time()
+
+        def report():
+            elapsed = time.time() - start
+            stats = dict(counters, elapsed=elapsed,
+                         throughput=counters['done'] / max(elapsed, 1e-9))
+            try:
+                progress(stats)
+            except Exception:
+                log.exception('PAYSON: Progress callback failed')
+
+        for _, result, _ in _imap_unordered(update, updates, max_concurrency):
+            counters['done'] += 1
+            counters['succeeded' if result.ack == 'SUCCESS'
+                     else 'failed'] += 1
+            counters['retried'] += result.attempts > 1
+            if progress is not None and \
+                    counters['done'] % progress_every == 0:
+                report()
+            yield result
+        if progress is not None:
+            report()
+
+    def validate(self, message):
+        """This method is used to validate the content of the IPN message that was sent to your ipnNotificationUrl.
+
+        For a longer description, including possible parameter values, see 
+        https://api.payson.se/#Validaterequest
+
+        :param message: complete unaltered query string from the IPN request,
+                        or a RawResponseData or PaymentDetails read from it
+        :type message: str 
+        :returns: True if IPN is verified, otherwise False
+        :rtype: bool
+        """
+        if not isinstance(message, basestring):
+            raw = getattr(message, 'raw', None)
+            if raw is None:
+                raise ValueError('The unaltered IPN message is not known.')
+            message = raw
+        response = self._call(self.validate_ipn_cmd, message, str,
+                              self._deadline(), True)
+        log.info('PAYSON: %s response: %r', self.validate_ipn_cmd, response)
+        if response == 'VERIFIED':
+            if self.cache is not None:
+                token = RawResponseData(message).get('token')
+                if token is not None:
+                    self.cache.invalidate(token)
+            return True
+        elif response == 'INVALID':
+            return False
+        else:
+            raise ValueError('Invalid response for IPN validation.')
+
+    def add_listener(self, listener):
+        """Report calls made by this instance to listener.
+
+        :type listener: CallListener
+        """
+        self.listeners.append(listener)
+
+    def close(self):
+        """Close connections held by the transport of this instance."""
+        self.transport.close()
+
+    def _call(self, cmd, query, parse, deadline=None, idempotent=False):
+        """Send query to cmd and return parse(response body).
+
+        Listeners are told about the call, its timings and outcome. 
+        Idempotent calls are repeated according to self.retry.
+        """
+        if not self.listeners:
+            return parse(self._send_request(cmd, query, None, deadline,
+                                            idempotent))
+        event = CallEvent(cmd, query)
+        self._notify('call_started', event)
+        try:
+            body = self._send_request(cmd, query, event.timings, deadline,
+                                      idempotent)
+            event.response_size = len(body)
+            start = time.time()
+            response = parse(body)
+            event.timings['parse'] = time.time() - start
+            envelope = getattr(response, 'responseEnvelope', response)
+            if isinstance(envelope, ResponseEnvelope):
+                event.ack = envelope.ack
+                event.error_ids = [e.errorId for e in envelope.errorList]
+            else:
+                event.ack = response
+            return response
+        except Exception, e:
+            event.exception = e
+            raise
+        finally:
+            event.duration = time.time() - event.started
+            self._notify('call_finished', event)
+
+    def _notify(self, method, event):
+        for listener in self.listeners:
+            try:
+                getattr(listener, method)(event)
+            except Exception:
+                log.exception('PAYSON: Listener %r failed', listener)
+
+    def _decode(self, cmd, body):
+        data = RawResponseData(body) if self.keep_raw \
+            else decode_response(body)
+        log.info('PAYSON: %s response: %r', cmd, data)
+        return data
+
+    def _payment_update(self, token, action):
+        if self.cache is not None:
+            self.cache.invalidate(token)
+        cmd = self.update_payment_details_cmd
+        envelope = self._call(
+            cmd, urllib.urlencode({'token': token, 'action': action}),
+            lambda body: ResponseEnvelope(self._decode(cmd, body)),
+            self._deadline())
+        if self.cache is not None:
+            self.cache.invalidate(token)
+        return envelope
+
+    def _update_with_retries(self, update, retry, limiter):
+        token, action = update
+        attempt = 1
+        while True:
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                envelope = self._payment_update(token, action)
+                return PaymentUpdateResult(token, action, envelope.ack,
+                                           envelope.errorList, attempt, None)
+            except Exception, e:
+                delay = retry.delay(attempt, e)
+                if delay is None:
+                    return PaymentUpdateResult(token, action, None, [],
+                                               attempt, e)
+            time.sleep(delay)
+            try:
+                applied = self._update_applied(token, action)
+            except Exception, check_error:
+                # Whether the update was applied is unknown, do not resend
+                log.warning('PAYSON: Could not check %s: %s', token,
+                            check_error)
+                return PaymentUpdateResult(token, action, None, [], attempt,
+                                           e)
+            if applied:
+                return PaymentUpdateResult(token, action, 'SUCCESS', [],
+                                           attempt, None)
+            attempt += 1
+
+    def _update_applied(self, token, action):
+        """True if payment_details shows that action has been done."""
+        details = self.payment_details(token)
+        state = details.invoiceStatus \
+            if details.type == 'INVOICE' else details.status
+        return state == _PAYMENT_UPDATE_STATES.get(action)
+
+    def _deadline(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        return time.time() + timeout if timeout is not None else None
+
+    def _hedged(self, call):
+        """Run call, and once more if it is slower than self.hedge allows.
+
+        The first successful result is returned, the other call is left to
+        finish in the background. Every successful call is observed by 
+        self.hedge when it finishes, a slow first call that lost to the 
+        hedge included, so the percentile is not skewed towards fast calls.
+        Each call runs on a new thread, also when no hedge is sent.
+        """
+        results = Queue.Queue()
+
+        def run():
+            start = time.time()
+            try:
+                result = call()
+            except Exception, e:
+                results.put((False, e))
+            else:
+                self.hedge.observe(time.time() - start)
+                results.put((True, result))
+
+        def launch():
+            thread = threading.Thread(target=run)
+            thread.daemon = True
+            thread.start()
+
+        launch()
+        launched = 1
+        try:
+            outcome = results.get(timeout=self.hedge.delay())
+        except Queue.Empty:
+            log.info('PAYSON: Hedging slow call')
+            self.hedge.hedges += 1
+            launch()
+            launched = 2
+            outcome = results.get()
+        received = 1
+        while not outcome[0] and received < launched:
+            outcome = results.get()
+            received += 1
+        succeeded, result = outcome
+        if not succeeded:
+            raise result
+        return result
+
+    def _send_request(self, cmd, query, timings=None, deadline=None,
+                      idempotent=False):
+        log.info('PAYSON: Calling %s with %r', cmd, query)
+        attempt = 1
+        while True:
+            try:
+                return self._send_once(cmd, query, self._headers, timings,
+                                       deadline)
+            except urllib2.URLError, e:
+                log.error('Exception when calling %s: %s', cmd, e)
+                delay = None
+                if idempotent and self.retry is not None:
+                    delay = self.retry.delay(attempt, e)
+                if delay is None or (deadline is not None and
+                                     time.time() + delay >= deadline):
+                    raise
+            log.info('PAYSON: Retrying %s in %.3f s', cmd, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def _send_once(self, cmd, query, headers, timings, deadline):
+        if deadline is not None and deadline <= time.time():
+            raise DeadlineExceeded(cmd)
+        if self._slots is not None and not self._slots.acquire(deadline):
+            raise DeadlineExceeded(cmd)
+        try:
+            timeout = None
+            if deadline is not None:
+                # what is left after waiting for a slot
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    raise DeadlineExceeded(cmd)
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.before_call(cmd)
+            try:
+                body = self.transport.send(
+                    cmd, query, headers,
+                    **_send_options(self.transport, timings, timeout))
+            except Exception, e:
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.record(e)
+                if (isinstance(e, urllib2.URLError) and
+                        deadline is not None and time.time() >= deadline):
+                    raise DeadlineExceeded(cmd)
+                raise
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record()
+        return body
+
+
+class AsyncPaysonApi(object):
+    """Runs the calls of a PaysonApi on a bounded pool of worker threads.
+
+    pay, payment_details, payment_update and validate take the same 
+    arguments as in PaysonApi but return immediately with a 
+    multiprocessing.pool.AsyncResult, call get() on it to wait for the usual
+    return value. Many calls can be in flight without a thread per call, 
+    they share the workers and pooled connections.
+
+    The methods return something else than those of PaysonApi, so this 
+    wraps a PaysonApi rather than extends it. Pass api where a PaysonApi is
+    expected.
+    """
+    def __init__(self, user_id, user_key, pool=None, workers=10, **kwargs):
+        """Constructor
+
+        Takes the arguments of PaysonApi and:
+
+        :param workers: Max number of calls in flight at the same time
+        :type workers: int
+        """
+        self.api = PaysonApi(user_id, user_key, pool, **kwargs)
+        self.workers = workers
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @property
+    def user_id(self):
+        return self.api.user_id
+
+    @property
+    def user_key(self):
+        return self.api.user_key
+
+    @property
+    def transport(self):
+        return self.api.transport
+
+    def pay(self, *args, **kwargs):
+        """Asynchronous PaysonApi.pay
+
+        :rtype: AsyncResult of PayResponse
+        """
+        return self._submit(self.api.pay, args, kwargs)
+
+    def payment_details(self, *args, **kwargs):
+        """Asynchronous PaysonApi.payment_details
+
+        :rtype: AsyncResult of PaymentDetailsResponse
+        """
+        return self._submit(self.api.payment_details, args, kwargs)
+
+    def payment_update(self, *args, **kwargs):
+        """Asynchronous PaysonApi.payment_update
+
+        :rtype: AsyncResult of bool
+        """
+        return self._submit(self.api.payment_update, args, kwargs)
+
+    def validate(self, *args, **kwargs):
+        """Asynchronous PaysonApi.validate
+
+        :rtype: AsyncResult of bool
+        """
+        return self._submit(self.api.validate, args, kwargs)
+
+    def add_listener(self, listener):
+        """PaysonApi.add_listener"""
+        self.api.add_listener(listener)
+
+    def close(self):
+        """Wait for calls in flight, then stop workers and close connections.
+        """
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.close()
+            executor.join()
+        self.api.close()
+
+    def _submit(self, method, args, kwargs):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = multiprocessing.pool.ThreadPool(self.workers)
+            executor = self._executor
+        return executor.apply_async(method, args, kwargs)
+
+
+def _blocking_api(api):
+    """api, unless it is an AsyncPaysonApi where a PaysonApi is needed."""
+    if isinstance(api, AsyncPaysonApi):
+        raise TypeError('A PaysonApi is needed, not an AsyncPaysonApi, '
+                        'pass its api attribute')
+    return api
+
+
+class MerchantRegistry(object):
+    """Hands out a client per merchant, all sharing one transport.
+
+    Clients differ only in their credentials, connections to Payson are 
+    pooled across all merchants. Each merchant can have its own limit of 
+    requests in flight and gets its own MetricsListener.
+
+        registry = MerchantRegistry(pool=ConnectionPool(maxsize=50))
+        registry.add(user_id, user_key, max_concurrency=5)
+        registry.get(user_id).payment_details(token)
+
+    Close the registry rather than the clients, they share the transport.
+    """
+    def __init__(self, transport=None, pool=None, api_class=PaysonApi,
+                 max_concurrency=None, metrics=True, **kwargs):
+        """Constructor
+
+        :param transport: Shared by all clients, by default a 
+                          PooledTransport using pool
+        :type transport: Transport
+        :param pool: Connection pool of the default transport
+        :type pool: ConnectionPool
+        :param api_class: PaysonApi, a subclass or AsyncPaysonApi
+        :param max_concurrency: Default max number of requests in flight 
+                                per merchant
+        :type max_concurrency: int
+        :param metrics: Give every client a MetricsListener
+        :type metrics: bool
+
+        Other keyword arguments are passed to api_class for every merchant.
+        """
+        self.transport = transport if transport is not None \
+            else PooledTransport(pool)
+        self.api_class = api_class
+        self.max_concurrency = max_concurrency
+        self.metrics_enabled = metrics
+        self.kwargs = kwargs
+        self._clients = {}
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def add(self, user_id, user_key, max_concurrency=None, **kwargs):
+        """Create, or replace, the client of a merchant.
+
+        Keyword arguments override those given to the constructor.
+
+        :param max_concurrency: Max number of requests in flight for this
+                                merchant in place of the default
+        :type max_concurrency: int
+        :rtype: PaysonApi
+        """
+        with self._lock:
+            return self._add(user_id, user_key, max_concurrency, kwargs)
+
+    def get(self, user_id, user_key=None):
+        """The client of a merchant.
+
+        With user_key a client is created if there is none, or if the key 
+        changed. Concurrent first calls for a merchant get the same client.
+
+        :rtype: PaysonApi
+        :raises KeyError: if user_id is unknown and no user_key is given
+        """
+        with self._lock:
+            api = self._clients.get(user_id)
+            if api is None or (user_key is not None and
+                               api.user_key != user_key):
+                if user_key is None:
+                    raise KeyError(user_id)
+                api = self._add(user_id, user_key, None, {})
+            return api
+
+    def _add(self, user_id, user_key, max_concurrency, kwargs):
+        # with self._lock held, creating a client does no I/O
+        options = dict(self.kwargs)
+        options.update(kwargs)
+        options['transport'] = self.transport
+        options['max_concurrency'] = max_concurrency \
+            if max_concurrency is not None else self.max_concurrency
+        api = self.api_class(user_id, user_key, **options)
+        metrics = None
+        if self.metrics_enabled:
+            metrics = MetricsListener()
+            api.add_listener(metrics)
+        self._clients[user_id] = api
+        self._metrics[user_id] = metrics
+        return api
+
+    def remove(self, user_id):
+        """Forget a merchant."""
+        with self._lock:
+            self._clients.pop(user_id, None)
+            self._metrics.pop(user_id, None)
+
+    def metrics(self, user_id):
+        """The MetricsListener of a merchant, None if metrics are disabled.
+        """
+        return self._metrics[user_id]
+
+    def snapshot(self):
+        """Metrics snapshots by user_id."""
+        with self._lock:
+            metrics = self._metrics.items()
+        return dict((user_id, listener.snapshot())
+                    for user_id, listener in metrics if listener is not None)
+
+    def __contains__(self, user_id):
+        return user_id in self._clients
+
+    def __len__(self):
+        return len(self._clients)
+
+    def close(self):
+        """Close all clients and the shared transport."""
+        with self._lock:
+            clients = self._clients.values()
+        for api in clients:
+            api.close()
+        self.transport.close()
+
+
+class IpnStore(object):
+    """Interface of the store used by IpnDeduplicator.
+
+    Implement it on top of e.g. memcached or Redis to deduplicate IPN 
+    messages between processes.
+    """
+    def add(self, key, ttl):
+        """Store key for ttl seconds unless already stored.
+
+        Must be atomic, like memcached add or Redis SET with NX and EX.
+
+        :returns: True if key was stored
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def discard(self, key):
+        """Remove key if stored."""
+        raise NotImplementedError
+
+
+class MemoryIpnStore(IpnStore):
+    """IpnStore for a single process, keeping at most maxsize keys."""
+
+    def __init__(self, maxsize=10000):
+        self._keys = _TtlLruCache(maxsize, None)
+        self._lock = threading.Lock()
+
+    def add(self, key, ttl):
+        with self._lock:
+            if self._keys.get(key) is not None:
+                return False
+            self._keys.set(key, True, ttl)
+            return True
+
+    def discard(self, key):
+        self._keys.pop(key)
+
+
+class IpnDeduplicator(object):
+    """Detects repeated IPN messages by a digest of the raw message.
+
+    Payson repeats notifications until delivered, use claim to process a
+    message only the first time it is seen within window seconds.
+    """
+    def __init__(self, window=3600, store=None):
+        """Constructor
+
+        :param window: Seconds a message is remembered
+        :type window: float
+        :param store: Where digests are kept, by default in this process
+        :type store: IpnStore
+        """
+        self.window = window
+        self.store = store if store is not None else MemoryIpnStore()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(message):
+        return hashlib.sha1(message).hexdigest()
+
+    def claim(self, message):
+        """Record message as seen.
+
+        :returns: False if message was already seen within the window
+        :rtype: bool
+        """
+        claimed = self.store.add(self.digest(message), self.window)
+        with self._lock:
+            if claimed:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return claimed
+
+    def release(self, message):
+        """Forget message, for instance when its validation failed."""
+        self.store.discard(self.digest(message))
+
+    @property
+    def hit_ratio(self):
+        """Share of claimed messages that were duplicates."""
+        claims = self.hits + self.misses
+        return float(self.hits) / claims if claims else 0.0
+
+
+DeadLetter = collections.namedtuple('DeadLetter', 'message reason')
+
+
+class IpnProcessor(object):
+    """Validates and dispatches IPN messages on background worker threads.
+
+    Raw IPN query strings are queued with submit, validated through 
+    PaysonApi.validate, decoded into PaymentDetails and passed to every
+    registered handler. Messages that are INVALID, fail to validate or 
+    decode, or make a handler raise end up in dead_letters as DeadLetter
+    tuples with the exception, or 'INVALID', as reason.
+
+    With a deduplicator, repeated messages are dropped and counted as 
+    duplicates without being validated again. Messages ending up in 
+    dead_letters are forgotten by the deduplicator, so they are processed 
+    again when Payson repeats them.
+    """
+    _stop = object()
+
+    def __init__(self, api, handlers=(), workers=4, max_queue=1000,
+                 max_dead_letters=1000, deduplicator=None, keep_raw=False):
+        """Constructor
+
+        :param api: Used to validate messages, its connection pool should
+                    keep at least as many connections as there are workers
+        :type api: PaysonApi
+        :param handlers: Callables taking a PaymentDetails instance
+        :param workers: Max number of messages processed at the same time
+        :type workers: int
+        :param max_queue: Max number of messages waiting to be processed
+        :type max_queue: int
+        :param max_dead_letters: Max number of dead letters kept
+        :type max_dead_letters: int
+        :type deduplicator: IpnDeduplicator
+        :param keep_raw: Give handlers PaymentDetails read through 
+                         RawResponseData, keeping the message as raw
+        :type keep_raw: bool
+        """
+        self.api = _blocking_api(api)
+        self.deduplicator = deduplicator
+        self.keep_raw = keep_raw
+        self.handlers = list(handlers)
+        self.workers = workers
+        self.queue = Queue.Queue(max_queue)
+        self.dead_letters = collections.deque(maxlen=max_dead_letters)
+        self.received = 0
+        self.rejected = 0
+        self.verified = 0
+        self.invalid = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.dispatched = 0
+        self.started = None
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def add_handler(self, handler):
+        """Register a callable taking a PaymentDetails instance."""
+        self.handlers.append(handler)
+
+    def start(self):
+        """Start the worker threads."""
+        self.started = time.time()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, message, block=True, timeout=None):
+        """Queue a message for processing.
+
+        When the queue is full this waits for room, or if block is False or
+        timeout expires the message is rejected.
+
+        :param message: complete unaltered query string from the IPN request
+        :type message: str
+        :returns: False if the message was rejected
+        :rtype: bool
+        """
+        try:
+            self.queue.put(message, block, timeout)
+        except Queue.Full:
+            self._count('rejected')
+            return False
+        self._count('received')
+        return True
+
+    def join(self):
+        """Wait until all queued messages have been processed."""
+        self.queue.join()
+
+    def stop(self):
+        """Process the queued messages, then stop the worker threads."""
+        for _ in self._threads:
+            self.queue.put(self._stop)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    @property
+    def throughput(self):
+        """Dispatched messages per second since start."""
+        if self.started is None:
+            return 0.0
+        return self.dispatched / max(time.time() - self.started, 1e-9)
+
+    def stats(self):
+        """Counters and throughput as a dict."""
+        return {'received': self.received,
+                'rejected': self.rejected,
+                'verified': self.verified,
+                'invalid': self.invalid,
+                'failed': self.failed,
+                'duplicates': self.duplicates,
+                'dispatched': self.dispatched,
+                'queued': self.queue.qsize(),
+                'dead_letters': len(self.dead_letters),
+                'throughput': self.throughput}
+
+    def _work(self):
+        while True:
+            message = self.queue.get()
+            try:
+                if message is self._stop:
+                    return
+                self._process(message)
+            finally:
+                self.queue.task_done()
+
+    def _process(self, message):
+        if (self.deduplicator is not None and
+                not self.deduplicator.claim(message)):
+            self._count('duplicates')
+            return
+        try:
+            verified = self.api.validate(message)
+        except Exception, e:
+            log.warning('PAYSON: IPN validation failed: %s', e)
+            self._dead_letter(message, e, 'failed')
+            return
+        if not verified:
+            self._dead_letter(message, 'INVALID', 'invalid')
+            return
+        self._count('verified')
+        try:
+            payment_details = PaymentDetails(
+                RawResponseData(message) if self.keep_raw
+                else decode_response(message))
+            for handler in self.handlers:
+                handler(payment_details)
+        except Exception, e:
+            log.exception('PAYSON: IPN processing failed')
+            self._dead_letter(message, e, 'failed')
+            return
+        self._count('dispatched')
+
+    def _dead_letter(self, message, reason, counter):
+        # not processed after all, let the message in again when repeated
+        if self.deduplicator is not None:
+            self.deduplicator.release(message)
+        self.dead_letters.append(DeadLetter(message, reason))
+        self._count(counter)
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+class _Tracked(object):
+    __slots__ = ('callbacks', 'details', 'interval', 'failures', 'due')
+
+    def __init__(self, interval):
+        self.callbacks = []
+        self.details = None
+        self.interval = interval
+        self.failures = 0
+        self.due = None
+
+
+class StatusPoller(object):
+    """Polls payment_details of tracked payments until they are finished.
+
+    Each tracked token is polled at an interval depending on its status and
+    type, see intervals, which grows by backoff for every poll without a 
+    change. Tokens are polled once however many callers track them. When 
+    status or invoiceStatus changes the handlers and the callbacks of the 
+    token are called with the previous PaymentDetails, None on the first 
+    poll, and the new one. Finished payments, see is_finished, are no longer
+    tracked.
+
+    Details received by other means, for instance from IPN messages, can be
+    passed to update to save a poll, e.g. processor.add_handler(poller.update)
+    """
+    intervals = {'CREATED': 5,
+                 'PENDING': 10,
+                 'PROCESSING': 10,
+                 ('INVOICE', 'PENDING'): 300}
+    invoice_finished_statuses = ('DONE', 'CANCELED', 'CREDITED')
+
+    def __init__(self, api, handlers=(), workers=4, first_interval=2,
+                 default_interval=30, backoff=1.5, max_interval=3600,
+                 max_failures=10):
+        """Constructor
+
+        :type api: PaysonApi
+        :param handlers: Callables taking the previous and current 
+                         PaymentDetails of any tracked payment
+        :param workers: Max number of polls in flight at the same time
+        :type workers: int
+        :param first_interval: Seconds before the first poll of a token
+        :type first_interval: float
+        :param default_interval: Seconds between polls for statuses not in
+                                 intervals
+        :type default_interval: float
+        :param backoff: Factor the interval grows by for each poll without
+                        a change, or failing poll
+        :type backoff: float
+        :param max_interval: Max seconds between polls
+        :type max_interval: float
+        :param max_failures: Failed polls in a row before a token is dropped
+        :type max_failures: int
+        """
+        self.api = _blocking_api(api)
+        self.handlers = list(handlers)
+        self.workers = workers
+        self.first_interval = first_interval
+        self.default_interval = default_interval
+        self.backoff = backoff
+        self.max_interval = max_interval
+        self.max_failures = max_failures
+        self.polls = 0
+        self.failed = 0
+        self.transitions = 0
+        self.finished = 0
+        self.dropped = 0
+        self._tracked = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._executor = None
+
+    def add_handler(self, handler):
+        """Register a callable taking the previous and current PaymentDetails.
+        """
+        self.handlers.append(handler)
+
+    def track(self, token, callback=None, details=None):
+        """Poll token until the payment is finished.
+
+        :param token: e.g. PayResponse.token
+        :type token: unicode
+        :param callback: Callable taking the previous and current 
+                         PaymentDetails when the status changes
+        :param details: Current details if known, polling then starts at 
+                        the interval of its status
+        :type details: PaymentDetails
+        """
+        with self._condition:
+            tracked = self._tracked.get(token)
+            if tracked is None:
+                tracked = self._tracked[token] = _Tracked(self.first_interval)
+                self._schedule(token, tracked)
+            if callback is not None:
+                tracked.callbacks.append(callback)
+        if details is not None:
+            self._observe(token, details)
+
+    def untrack(self, token):
+        """Stop polling token."""
+        with self._condition:
+            self._tracked.pop(token, None)
 
+    def update(self, details):
+        """Take new details of a tracked payment, e.g. from an IPN message.
 
-class PaysonApi():
+        :type details: PaymentDetails
+        """
+        self._observe(details.token, details)
+
+    def is_finished(self, details):
+        """True if details will not change any more.
+
+        Override to stop polling earlier, e.g. at invoiceStatus ORDERCREATED.
+
+        :type details: PaymentDetails
+        :rtype: bool
+        """
+        if details.type == 'INVOICE' and details.invoiceStatus:
+            return details.invoiceStatus in self.invoice_finished_statuses
+        return details.status in PAYSON_TERMINAL_STATUSES
+
+    def interval(self, details):
+        """Seconds between polls of a payment that just got details.
+
+        :type details: PaymentDetails
+        :rtype: float
+        """
+        return self.intervals.get(
+            (details.type, details.status),
+            self.intervals.get(details.status, self.default_interval))
+
+    @property
+    def pending(self):
+        """Number of tokens tracked."""
+        return len(self._tracked)
+
+    def start(self):
+        """Start polling in the background."""
+        self._executor = multiprocessing.pool.ThreadPool(self.workers)
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop polling, waiting for polls in flight."""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is None:
+            return
+        self._thread.join()
+        self._thread = None
+        self._executor.close()
+        self._executor.join()
+        self._executor = None
+
+    def stats(self):
+        """Counters as a dict."""
+        return {'pending': self.pending,
+                'polls': self.polls,
+                'failed': self.failed,
+                'transitions': self.transitions,
+                'finished': self.finished,
+                'dropped': self.dropped}
+
+    def _schedule(self, token, tracked):
+        # superseded entries stay in the heap, they are skipped by due
+        tracked.due = time.time() + tracked.interval
+        heapq.heappush(self._heap, (tracked.due, next(self._sequence), token))
+        self._condition.notify()
+
+    def _run(self):
+        with self._condition:
+            while self._running:
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    due, _, token = heapq.heappop(self._heap)
+                    tracked = self._tracked.get(token)
+                    if tracked is not None and tracked.due == due:
+                        tracked.due = None
+                        self._executor.apply_async(self._poll, (token, ))
+                self._condition.wait(self._heap[0][0] - now
+                                     if self._heap else None)
+
+    def _poll(self, token):
+        self._count('polls')
+        try:
+            details = self.api.payment_details(token)
+            if not details.success:
+                raise ValueError('PaymentDetails failed: %r' %
+                                 details.responseEnvelope.errorList)
+        except Exception, e:
+            log.warning('PAYSON: Polling %s failed: %s', token, e)
+            self._count('failed')
+            with self._condition:
+                tracked = self._tracked.get(token)
+                if tracked is None:
+                    return
+                tracked.failures += 1
+                if tracked.failures >= self.max_failures:
+                    log.error('PAYSON: Giving up polling %s', token)
+                    del self._tracked[token]
+                    self.dropped += 1
+                    return
+                tracked.interval = min(self.max_interval,
+                                       tracked.interval * self.backoff)
+                self._schedule(token, tracked)
+            return
+        self._observe(token, details)
+
+    def _observe(self, token, details):
+        with self._condition:
+            tracked = self._tracked.get(token)
+            if tracked is None:
+                return
+            previous = tracked.details
+            changed = (previous is None or
+                       (previous.status, previous.invoiceStatus) !=
+                       (details.status, details.invoiceStatus))
+            tracked.details = details
+            tracked.failures = 0
+            finished = self.is_finished(details)
+            if finished:
+                del self._tracked[token]
+                self.finished += 1
+            else:
+                if changed:
+                    tracked.interval = self.interval(details)
+                else:
+                    tracked.interval = min(self.max_interval,
+                                           tracked.interval * self.backoff)
+                self._schedule(token, tracked)
+            if changed:
+                self.transitions += 1
+            callbacks = self.handlers + tracked.callbacks
+        if changed:
+            for callback in callbacks:
+                try:
+                    callback(previous, details)
+                except Exception:
+                    log.exception('PAYSON: Status callback %r failed',
+                                  callback)
+
+    def _count(self, counter):
+        with self._condition:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+_EXPORT_ATTRIBUTES = ('purchaseId', 'status', 'type', 'invoiceStatus',
+                      'guaranteeStatus', 'guaranteeDeadlineTimestamp',
+                      'currencyCode', 'senderEmail', 'trackingId', 'custom',
+                      'amount', 'receiverFee')
+_EXPORT_ADDRESS_FIELDS = ('name', 'streetAddress', 'postalCode', 'city',
+                          'country')
+EXPORT_COLUMNS = (('token', ) + _EXPORT_ATTRIBUTES + ('receiverList', ) +
+                  tuple('shippingAddress.' + field
+                        for field in _EXPORT_ADDRESS_FIELDS) +
+                  ('error', ))
+
+
+def export_record(token, details=None, error=None):
+    """Values of EXPORT_COLUMNS for a payment, or for a failed lookup.
+
+    :type token: unicode
+    :type details: PaymentDetails
+    :param error: Why details could not be fetched, an exception or the 
+                  errorList of a failed response, written as 
+                  'errorId: message' pairs
+    :rtype: collections.OrderedDict
+    """
+    record = collections.OrderedDict.fromkeys(EXPORT_COLUMNS)
+    record['token'] = token
+    if details is None:
+        if isinstance(error, list):
+            error = '; '.join('%s: %s' % (e.errorId, e.message)
+                              for e in error)
+        elif isinstance(error, Exception):
+            error = '%s: %s' % (type(error).__name__, error)
+        record['error'] = error
+        return record
+    for attribute in _EXPORT_ATTRIBUTES:
+        record[attribute] = getattr(details, attribute)
+    record['receiverList'] = [
+        collections.OrderedDict((('email', receiver.email),
+                                 ('amount', receiver.amount),
+                                 ('primary', receiver.primary)))
+        for receiver in details.receiverList]
+    if 'shippingAddress.name' in details.post_data:
+        address = details.shippingAddress
+        for field in _EXPORT_ADDRESS_FIELDS:
+            record['shippingAddress.' + field] = getattr(address, field)
+    return record
+
+
+def _json_default(value):
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % (value, ))
+
+
+def _csv_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=_json_default)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return str(value)
 
-    def __init__(self, user_id, user_key):
+
+class PaymentExporter(object):
+    """Writes details of many payments to a CSV or JSON lines file.
+
+    Details are fetched concurrently, but rows are written one at a time in
+    the order of the tokens, so memory use does not grow with their number.
+    Failed lookups get a row with only token and error. Columns are 
+    EXPORT_COLUMNS, receiverList is a JSON list in CSV files.
+
+    With a checkpoint_path, the number of tokens done and the size of the 
+    sink are saved when the export starts and every checkpoint_every rows.
+    Calling export again with the same tokens and the sink reopened for 
+    appending continues from the last checkpoint, rows written after it are 
+    truncated.
+    """
+    def __init__(self, api, sink, format='csv', max_concurrency=10,
+                 checkpoint_path=None, checkpoint_every=1000):
         """Constructor
 
-        :param user_id: Agent ID obtained from Payson
-        :type user_id: str
-        :param user_key: Password (MD5 Key) obtained from Payson
-        :type user_key: str
+        :type api: PaysonApi
+        :param sink: File opened in binary mode
+        :param format: 'csv' or 'jsonl'
+        :type format: str
+        :param max_concurrency: Max number of lookups in flight
+        :type max_concurrency: int
+        :param checkpoint_path: Where to save progress, None to not save it
+        :type checkpoint_path: str
+        :param checkpoint_every: Rows written between checkpoints
+        :type checkpoint_every: int
         """
-        if (user_id in PAYSON_TEST_AGENT_ID and
-            user_key in PAYSON_TEST_AGENT_KEY):
-            endpoint = PAYSON_TEST_API_ENDPOINT
-            self.forward_pay_url = PAYSON_WWW_PAY_FORWARD_TEST_URL
+        if format not in ('csv', 'jsonl'):
+            raise ValueError('Unknown export format %r' % format)
+        self.api = _blocking_api(api)
+        self.sink = sink
+        self.format = format
+        self.max_concurrency = max_concurrency
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.exported = 0
+        self.failed = 0
+
+    def export(self, tokens):
+        """Fetch and write details of tokens, after the last checkpoint.
+
+        :type tokens: iterable of unicode
+        :returns: number of rows written by this call
+        :rtype: int
+        """
+        position, offset = self._load_checkpoint()
+        if offset is None:
+            # Mark where this export starts, so that a rerun after a crash
+            # before the first checkpoint truncates everything written
+            self._save_checkpoint(position)
         else:
-            endpoint = PAYSON_API_ENDPOINT
-            self.forward_pay_url = PAYSON_WWW_PAY_FORWARD_URL
+            self.sink.seek(offset)
+            self.sink.truncate()
+        if self.format == 'csv':
+            writer = csv.writer(self.sink)
+            write = lambda record: writer.writerow(
+                [_csv_cell(value) for value in record.itervalues()])
+            if position == 0:
+                writer.writerow(EXPORT_COLUMNS)
+        else:
+            write = lambda record: self.sink.write(
+                json.dumps(record, default=_json_default) + '\n')
+        written = 0
+        for token, details, error in _imap_ordered(
+                self._lookup, itertools.islice(tokens, position, None),
+                self.max_concurrency):
+            if error is None and not details.success:
+                error = details.errorList
+            if error is not None:
+                log.warning('PAYSON: Export of %s failed: %s', token, error)
+                self.failed += 1
+                details = None
+            write(export_record(token, details, error))
+            written += 1
+            position += 1
+            if written % self.checkpoint_every == 0:
+                self._save_checkpoint(position)
+        self._save_checkpoint(position)
+        self.exported += written
+        return written
 
-        self.user_id = user_id
-        self.user_key = user_key
+    def _lookup(self, token):
+        """PaymentDetailsResponse of token, or the ResponseEnvelope of a 
+        failed request, which has none of the payment fields."""
+        api = self.api
+        cmd = api.get_payment_details_cmd
 
-        def mkcmd(cmd):
-            return '/'.join((endpoint, PAYSON_API_VERSION, cmd))
+        def parse(body):
+            data = api._decode(cmd, body)
+            envelope = ResponseEnvelope(data)
+            if not envelope.success:
+                return envelope
+            return PaymentDetailsResponse(data)
 
-        self.pay_cmd = mkcmd(PAYSON_API_PAY_ACTION)
-        self.get_payment_details_cmd = mkcmd(PAYSON_API_PAYMENT_DETAILS_ACTION)
-        self.update_payment_details_cmd = \
-            mkcmd(PAYSON_API_PAYMENT_UPDATE_ACTION)
-        self.validate_ipn_cmd = mkcmd(PAYSON_API_VALIDATE_ACTION)
-        self.send_ipn_cmd = mkcmd('SendIPN/')
+        return api._call(cmd, urllib.urlencode({'token': token}), parse,
+                         api._deadline(), True)
 
-    def pay(self,
-            returnUrl,
-            cancelUrl,
-            memo,
-            senderEmail,
-            senderFirstName,
-            senderLastName,
-            receiverList,
-            ipnNotificationUrl=None,
-            localeCode=None,
-            currencyCode=None,
-            fundingList=tuple(),
-            feesPayer=None,
-            invoiceFee=None,
-            custom=None,
-            trackingId=None,
-            guaranteeOffered=None,
-            orderItemList=tuple(),
-            showReceiptPage=True):
-        """The starting point for any kind of payment.
+    def _load_checkpoint(self):
+        if self.checkpoint_path is None:
+            return 0, None
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except IOError:
+            return 0, None
+        return checkpoint['position'], checkpoint['offset']
 
-        For a longer description, including possible parameter values and 
-        constraints, see https://api.payson.se/#Initializepayment
+    def _save_checkpoint(self, position):
+        self.sink.flush()
+        if self.checkpoint_path is None:
+            return
+        temporary = self.checkpoint_path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'position': position, 'offset': self.sink.tell()}, f)
+        os.rename(temporary, self.checkpoint_path)
 
-        :type returnUrl: unicode
-        :type cancelUrl: unicode
-        :type memo: unicode
-        :type senderEmail: unicode
-        :type senderFirstName: unicode
-        :type senderLastName: unicode
-        :type receiverList: iterable of Receiver instances
-        :type ipnNotificationUrl: unicode
-        :type localeCode: unicode
-        :type currencyCode: unicode
-        :type fundingList: iterable with unicode instances
-        :type feesPayer: unicode
-        :type invoiceFee: decimal.Decimal
-        :type custom: any json serializable Python object
-        :type trackingId: unicode or int
-        :type guaranteeOffered: unicode
-        :type orderItemList: iterable of OrderItem instances
-        :type showReceiptPage: bool
-        :rtype: PayResponse
-        """
-        pay_request = {'returnUrl': returnUrl,
-                       'cancelUrl': cancelUrl,
-                       'memo': memo.encode('utf-8'),
-                       'senderEmail': senderEmail.encode('utf-8'),
-                       'senderFirstName': senderFirstName.encode('utf-8'),
-                       'senderLastName': senderLastName.encode('utf-8')}
-        for i, v in enumerate(receiverList):
-            k = 'receiverList.receiver(%d).%s'
-            pay_request[k % (i, 'email')] = v.email.encode('utf-8')
-            pay_request[k % (i, 'amount')] = str(v.amount)
-            if v.primary is not None:
-                pay_request[k % (i, 'primary')] = json.dumps(v.primary)
-            if v.firstName:
-                pay_request[k % (i, 'firstName')] = v.firstName.encode('utf-8')
-            if v.lastName:
-                pay_request[k % (i, 'lastName')] = v.lastName.encode('utf-8')
-        if ipnNotificationUrl:
-            pay_request['ipnNotificationUrl'] = ipnNotificationUrl
-        if localeCode:
-            pay_request['localeCode'] = localeCode
-        if currencyCode:
-            pay_request['currencyCode'] = currencyCode
-        for i, v in enumerate(fundingList):
-            pay_request['fundingList.fundingConstraint'
-                        '(%d).constraint' % i] = v
-        if feesPayer:
-            pay_request['feesPayer'] = feesPayer
-        if invoiceFee is not None:
-            pay_request['invoiceFee'] = str(invoiceFee)
-        if custom is not None:
-            pay_request['custom'] = json.dumps(custom)
-        if trackingId is not None:
-            pay_request['trackingId'] = trackingId.encode('utf-8')
-        if guaranteeOffered:
-            pay_request['guaranteeOffered'] = guaranteeOffered
-        for i, v in enumerate(orderItemList):
-            k = 'orderItemList.orderItem(%d).%s'
-            pay_request[k % (i, 'description')] = v.description.encode('utf-8')
-            pay_request[k % (i, 'sku')] = str(v.sku)
-            pay_request[k % (i, 'quantity')] = str(v.quantity)
-            pay_request[k % (i, 'unitPrice')] = str(v.unitPrice)
-            pay_request[k % (i, 'taxPercentage')] = str(v.taxPercentage)
-        if showReceiptPage is False:
-            pay_request['showReceiptPage'] = json.dumps(showReceiptPage)
-        response_dict = self._do_request(self.pay_cmd, pay_request)
-        pay_response = PayResponse(self.forward_pay_url, response_dict)
-        log.info('PAYSON: %s response: %r' % (self.pay_cmd, response_dict))
-        return pay_response
 
-    def payment_details(self, token):
-        """Get details about an existing payment.
+def _find_groups(data):
+    """Groups of indexed fields, see ResponseData"""
+    indexed = {}
+    for key in data:
+        if '(' not in key:
+            continue
+        value = data[key]
+        try:
+            split = _split_keys[key]
+        except KeyError:
+            split = _split_key(key)
+            if len(_split_keys) >= 16384:
+                _split_keys.clear()
+            _split_keys[key] = split
+        _add_indexed(indexed, split, value)
+    return _collect_groups(indexed)
 
-        For a longer description, including possible parameter values, see 
-        https://api.payson.se/#PaymentDetailsrequest
 
-        :type token: unicode
-        :rtype: PaymentDetailsResponse
-        """
-        response_dict = self._do_request(
-            self.get_payment_details_cmd,
-            {'token': token})
-        payment_details_response = PaymentDetailsResponse(response_dict)
-        log.info('PAYSON: %s response: %r' % (self.get_payment_details_cmd,
-                                              response_dict))
-        return payment_details_response
+class _Groups(object):
+    """Finds the groups of a ResponseData not built by decode_response."""
 
-    def payment_update(self, token, action):
-        """Update an existing payment, for instance mark an order as shipped or canceled. 
+    def __get__(self, data, cls=None):
+        if data is None:
+            return self
+        data.groups = groups = _find_groups(data)
+        return groups
 
-        For a longer description, including possible parameter values, see 
-        https://api.payson.se/#PaymentUpdaterequest
 
-        :type token: unicode
-        :type action: unicode
-        :rtype: ResponseEnvelope
-        """
-        response_dict = self._do_request(
-            self.update_payment_details_cmd,
-            {'token': token,
-             'action': action})
-        response = ResponseEnvelope(response_dict)
-        log.info('PAYSON: %s response: %r' % (self.update_payment_details_cmd,
-                                              response_dict))
-        return response.ack == 'SUCCESS'
+class ResponseData(dict):
+    """Decoded NVP response or IPN message.
 
-    def validate(self, message):
-        """This method is used to validate the content of the IPN message that was sent to your ipnNotificationUrl.
+    A plain dict of field name to value, with indexed fields such as 
+    receiverList.receiver(0).email also collected in the groups attribute:
+    {'receiverList.receiver': [{'email': ..., 'amount': ...}, ...], ...}
+    Each group list is contiguous from index 0.
+    """
+    groups = _Groups()
 
-        For a longer description, including possible parameter values, see 
-        https://api.payson.se/#Validaterequest
 
-        :param message: complete unaltered query string from the IPN request
-        :type message: str 
-        :returns: True if IPN is verified, otherwise False
-        :rtype: bool
+_decoded_keys = {}
+
+
+def _decode_key(raw_key):
+    """Unquote a response field name and split indexed names.
+
+    Returns (key, group, index, field), group is None for plain fields. 
+    Field names repeat between responses, so results are memoized.
+    """
+    try:
+        return _decoded_keys[raw_key]
+    except KeyError:
+        pass
+    decoded = _split_key(urllib.unquote(raw_key.replace('+', ' ')))
+    if len(_decoded_keys) >= 16384:
+        _decoded_keys.clear()
+    _decoded_keys[raw_key] = decoded
+    return decoded
+
+
+def _split_key(key):
+    """'receiverList.receiver(0).email' -> 
+    ('receiverList.receiver(0).email', 'receiverList.receiver', 0, 'email')
+    """
+    start = key.find('(')
+    if start > 0:
+        end = key.find(').', start)
+        if end > 0 and key[start + 1:end].isdigit():
+            return (key, key[:start], int(key[start + 1:end]),
+                    key[end + 2:])
+    return (key, None, None, None)
+
+
+def decode_response(body):
+    """Decode an NVP response body or IPN query string in a single pass.
+
+    Gives the same fields as the first values of urlparse.parse_qs(body).
+
+    :type body: str
+    :rtype: ResponseData
+    """
+    data = ResponseData()
+    indexed = {}
+    pairs = body.split('&')
+    if ';' in body:
+        pairs = [pair for part in pairs for pair in part.split(';')]
+    unquote = urllib.unquote
+    for pair in pairs:
+        raw_key, sep, value = pair.partition('=')
+        if not value:
+            continue
+        key, group, index, field = _decode_key(raw_key)
+        if key in data:
+            continue
+        if '+' in value or '%' in value:
+            value = unquote(value.replace('+', ' '))
+        data[key] = value
+        if group is not None:
+            items = indexed.get(group)
+            if items is None:
+                items = indexed[group] = {}
+            item = items.get(index)
+            if item is None:
+                item = items[index] = {}
+            item[field] = value
+    data.groups = _collect_groups(indexed)
+    return data
+
+
+def _add_indexed(indexed, split, value):
+    key, group, index, field = split
+    if group is None:
+        return
+    items = indexed.get(group)
+    if items is None:
+        items = indexed[group] = {}
+    item = items.get(index)
+    if item is None:
+        item = items[index] = {}
+    item[field] = value
+
+
+def _collect_groups(indexed):
+    groups = {}
+    for name, items in indexed.iteritems():
+        group = groups[name] = []
+        while len(group) in items:
+            group.append(items[len(group)])
+    return groups
+
+
+_split_keys = {}
+
+SERIALIZATION_VERSION = 1
+
+
+def _pack(kind, fields):
+    """Serialize a list of str fields, see PaymentDetails.to_bytes
+
+    Fields are NUL separated, or marshalled in the rare case that one
+    contains NUL.
+    """
+    payload = '\0'.join(fields)
+    encoding = 'N'
+    if payload.count('\0') != len(fields) - 1:
+        payload = marshal.dumps(tuple(fields))
+        encoding = 'M'
+    return 'PS%c%s%s%s' % (SERIALIZATION_VERSION, kind, encoding, payload)
+
+
+def _unpack(data, kind):
+    if data[:2] != 'PS' or len(data) < 5:
+        raise ValueError('Not serialized Payson data')
+    if ord(data[2]) != SERIALIZATION_VERSION:
+        raise ValueError('Unsupported serialization version %d' %
+                         ord(data[2]))
+    if data[3] != kind:
+        raise ValueError('Serialized %r, not %r' % (data[3], kind))
+    if data[4] == 'M':
+        return list(marshal.loads(data[5:]))
+    return data[5:].split('\0')
+
+
+def _flatten(data):
+    return list(itertools.chain.from_iterable(data.iteritems()))
+
+
+def _restore_response_data(fields):
+    """ResponseData from alternating keys and values, as from _flatten.
+
+    Its groups are found when first used.
+    """
+    return ResponseData(itertools.izip(itertools.islice(fields, 0, None, 2),
+                                       itertools.islice(fields, 1, None, 2)))
+
+
+_timestamps = {}
+_decimals = {}
+
+
+def _parse_timestamp(value):
+    """Parse a Payson timestamp, '2014-03-01T12:30:05'
+
+    Like strptime with '%Y-%m-%dT%H:%M:%S', but much faster for this fixed
+    format. Timestamps repeat a lot under load, recent ones are memoized.
+    """
+    try:
+        return _timestamps[value]
+    except KeyError:
+        pass
+    if (len(value) == 19 and value[4] == value[7] == '-' and
+            value[10] == 'T' and value[13] == value[16] == ':' and
+            (value[:4] + value[5:7] + value[8:10] + value[11:13] +
+             value[14:16] + value[17:]).isdigit()):
+        timestamp = datetime.datetime(
+            int(value[:4]), int(value[5:7]), int(value[8:10]),
+            int(value[11:13]), int(value[14:16]), int(value[17:]))
+    else:
+        # for the error message
+        timestamp = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    if len(_timestamps) >= 1024:
+        _timestamps.clear()
+    _timestamps[value] = timestamp
+    return timestamp
+
+
+def _parse_decimal(value):
+    """decimal.Decimal(value), memoized for str values such as amounts."""
+    if not isinstance(value, str):
+        return decimal.Decimal(value)
+    try:
+        return _decimals[value]
+    except KeyError:
+        pass
+    number = decimal.Decimal(value)
+    if len(_decimals) >= 4096:
+        _decimals.clear()
+    _decimals[value] = number
+    return number
+
+
+class _Layout(object):
+    """Field names of a body and the position of their first value.
+
+    Shared by all bodies having the same fields in the same order.
+    """
+    __slots__ = ('keys', 'index')
+
+    def __init__(self, raw_keys):
+        keys = []
+        index = {}
+        for position, raw_key in enumerate(raw_keys):
+            key = _decode_key(raw_key)[0]
+            if key not in index:
+                index[key] = position
+                keys.append(key)
+        self.keys = tuple(keys)
+        self.index = index
+
+
+_layouts = {}
+
+
+class RawResponseData(collections.Mapping):
+    """Read only view of the fields of an NVP response or IPN message.
+
+    Has the same fields as decode_response(raw) but keeps only the body, in
+    raw, and the offsets of the values in it. Values are decoded on access
+    and field names are shared between bodies with the same layout, so it 
+    takes a fraction of the memory of a dict. The body can be passed as is
+    to PaysonApi.validate or archived.
+    """
+    __slots__ = ('raw', '_layout', '_offsets', '_groups')
+
+    def __init__(self, raw):
+        """Constructor
+
+        :param raw: Response body or complete IPN query string
+        :type raw: str
         """
-        response = self._send_request(self.validate_ipn_cmd, message)
-        log.info('PAYSON: %s response: %r' % (self.validate_ipn_cmd,
-                                              response))
-        if response == 'VERIFIED':
-            return True
-        elif response == 'INVALID':
-            return False
-        else:
-            raise ValueError('Invalid response for IPN validation.')
+        self.raw = raw
+        self._groups = None
+        raw_keys = []
+        offsets = array.array('I')
+        pairs = raw.split('&')
+        if ';' in raw:
+            pairs = [pair for part in pairs for pair in part.split(';')]
+        start = 0
+        for pair in pairs:
+            end = start + len(pair)
+            separator = pair.find('=')
+            if 0 <= separator < len(pair) - 1:
+                raw_keys.append(pair[:separator])
+                offsets.append(start + separator + 1)
+                offsets.append(end)
+            start = end + 1
+        raw_keys = tuple(raw_keys)
+        layout = _layouts.get(raw_keys)
+        if layout is None:
+            if len(_layouts) >= 1024:
+                _layouts.clear()
+            layout = _layouts[raw_keys] = _Layout(raw_keys)
+        self._layout = layout
+        self._offsets = offsets
 
-    def _do_request(self, cmd, data):
-        query = urllib.urlencode(data)
-        response_body = self._send_request(cmd, query)
-        data = urlparse.parse_qs(response_body)
-        return {k: v[0] for k, v in data.items()}
-
-    def _send_request(self, cmd, query):
-        request = urllib2.Request(cmd, query)
-        request.add_header('Content-Type', 'application/x-www-form-urlencoded')
-        request.add_header('PAYSON-SECURITY-USERID', self.user_id)
-        request.add_header('PAYSON-SECURITY-PASSWORD', self.user_key)
-        log.info('PAYSON: Calling %s with %r' % (cmd, query))
+    def __getitem__(self, key):
+        position = 2 * self._layout.index[key]
+        value = self.raw[self._offsets[position]:self._offsets[position + 1]]
+        if '+' in value or '%' in value:
+            value = urllib.unquote(value.replace('+', ' '))
+        return value
+
+    def __contains__(self, key):
+        return key in self._layout.index
+
+    def __iter__(self):
+        return iter(self._layout.keys)
+
+    def __len__(self):
+        return len(self._layout.keys)
+
+    @property
+    def groups(self):
+        """Indexed fields, see ResponseData"""
+        if self._groups is None:
+            self._groups = _find_groups(self)
+        return self._groups
+
+    def copy(self):
+        return self
+
+    def __reduce__(self):
+        return RawResponseData, (self.raw, )
+
+    def __repr__(self):
+        return 'RawResponseData(%r)' % self.raw
+
+
+class _lazy(object):
+    """Attribute decoded on first access and then kept in a slot.
+
+    Decorates the decoding method, the slot is named as the method prefixed
+    with an underscore and must be listed in __slots__ of the same class. 
+    Assigning to the attribute stores the value as is.
+    """
+    def __init__(self, decode):
+        self.decode = decode
+        self.slot_name = '_' + decode.__name__
+        self.slot = None
+        self.__doc__ = decode.__doc__
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        slot = self.slot or self._bind(type(obj))
         try:
-            response = urllib2.urlopen(request)
-        except urllib2.URLError, e:
-            log.error('Exception when calling {0}: {1}'.format(cmd, e))
-            raise
-        return response.read()
+            return slot.__get__(obj, cls)
+        except AttributeError:
+            value = self.decode(obj)
+            slot.__set__(obj, value)
+            return value
+
+    def __set__(self, obj, value):
+        (self.slot or self._bind(type(obj))).__set__(obj, value)
+
+    def _bind(self, cls):
+        for klass in cls.__mro__:
+            if self.slot_name in klass.__dict__:
+                self.slot = klass.__dict__[self.slot_name]
+                return self.slot
+        raise TypeError('%s has no slot %s' % (cls.__name__, self.slot_name))
+
+
+class _Slotted(object):
+    """Base for the compact model classes keeping attributes in __slots__.
+
+    Pickles the slots that are set, including decoded lazy attributes.
+    """
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = {}
+        for klass in type(self).__mro__:
+            for name in klass.__dict__.get('__slots__', ()):
+                try:
+                    state[name] = getattr(self, name)
+                except AttributeError:
+                    pass
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
 
 
 class OrderItem(object):
@@ -266,11 +2886,17 @@ class OrderItem(object):
         self.taxPercentage = taxPercentage
 
 
-class Receiver(object):
+class Receiver(_Slotted):
     """Holds receiver data.
 
-    Used both in pay request and in payment details objects.
+    Used both in pay request and in payment details objects. The amount of
+    receivers from responses is decoded on first access.
     """
+    # __dict__ keeps setting attributes of your own possible, it is only
+    # created when you do
+    __slots__ = ('email', '_amount', '_raw_amount', 'primary', 'firstName',
+                 'lastName', '__dict__')
+
     def __init__(self,
                  email,
                  amount,
@@ -278,20 +2904,45 @@ class Receiver(object):
                  firstName=None,
                  lastName=None):
         self.email = email
-        self.amount = decimal.Decimal(amount)
+        self._raw_amount = amount
+        self.amount = _parse_decimal(amount)
         self.primary = primary
         self.firstName = firstName
         self.lastName = lastName
 
+    @_lazy
+    def amount(self):
+        return _parse_decimal(self._raw_amount)
+
+    @classmethod
+    def _from_response(cls, email, amount, primary):
+        receiver = cls.__new__(cls)
+        receiver.email = email
+        receiver._raw_amount = amount
+        receiver.primary = primary
+        receiver.firstName = None
+        receiver.lastName = None
+        return receiver
+
     @classmethod
     def from_response_data(cls, data):
         receivers = []
+        if isinstance(data, (ResponseData, RawResponseData)):
+            for fields in data.groups.get('receiverList.receiver', ()):
+                if 'email' not in fields:
+                    break
+                primary = fields.get('primary')
+                primary = json.loads(primary.lower()) if primary else None
+                receivers.append(cls._from_response(
+                    fields['email'], fields['amount'], primary))
+            return receivers
         i = 0
         while 'receiverList.receiver(%d).email' % i in data:
             primary = data.get('receiverList.receiver(%d).primary' % i)
             primary = json.loads(primary.lower()) if primary else None
             receivers.append(
-                cls(data['receiverList.receiver(%d).email' % i],
+                cls._from_response(
+                    data['receiverList.receiver(%d).email' % i],
                     data['receiverList.receiver(%d).amount' % i],
                     primary)
             )
@@ -299,16 +2950,28 @@ class Receiver(object):
         return receivers
 
 
-class Error(object):
+class Error(_Slotted):
+    __slots__ = ('_errorId', '_raw_errorId', 'message', 'parameter')
 
     def __init__(self, errorId, message, parameter=None):
-        self.errorId = int(errorId)
+        self._raw_errorId = errorId
         self.message = message
         self.parameter = parameter
 
+    @_lazy
+    def errorId(self):
+        return int(self._raw_errorId)
+
     @classmethod
     def from_response_dict(cls, data):
         errors = []
+        if isinstance(data, (ResponseData, RawResponseData)):
+            for fields in data.groups.get('errorList.error', ()):
+                if 'errorId' not in fields:
+                    break
+                errors.append(cls(fields['errorId'], fields['message'],
+                                  fields.get('parameter')))
+            return errors
         i = 0
         while 'errorList.error(%d).errorId' % i in data:
             errors.append(
@@ -320,14 +2983,21 @@ class Error(object):
         return errors
 
 
-class ResponseEnvelope(object):
+class ResponseEnvelope(_Slotted):
+    __slots__ = ('_data', 'ack', '_timestamp', 'correlationId', '_errorList')
 
     def __init__(self, data):
+        self._data = data
         self.ack = data['responseEnvelope.ack']
-        self.timestamp = datetime.datetime.strptime(
-            data['responseEnvelope.timestamp'], '%Y-%m-%dT%H:%M:%S')
         self.correlationId = data['responseEnvelope.correlationId']
-        self.errorList = Error.from_response_dict(data)
+
+    @_lazy
+    def timestamp(self):
+        return _parse_timestamp(self._data['responseEnvelope.timestamp'])
+
+    @_lazy
+    def errorList(self):
+        return Error.from_response_dict(self._data)
 
     @property
     def success(self):
@@ -349,44 +3019,147 @@ class PayResponse(object):
         """True if request (not payment) succeeded."""
         return self.responseEnvelope.success
 
+    def to_bytes(self):
+        """Compact, versioned serialization, see PaymentDetails.to_bytes"""
+        return _pack('P', [self.forward_pay_url] +
+                     _flatten(self.responseEnvelope._data))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Instance serialized by to_bytes
+
+        :type data: str
+        :raises ValueError: if data is not a serialized PayResponse
+        """
+        fields = _unpack(data, 'P')
+        response = cls.__new__(cls)
+        response_data = _restore_response_data(fields[1:])
+        response.responseEnvelope = ResponseEnvelope(response_data)
+        response.token = response_data.get('TOKEN', '')
+        response.forward_pay_url = fields[0]
+        return response
+
 
-class ShippingAddress(object):
+class ShippingAddress(_Slotted):
     """Invoice shipping address info.
     """
+    __slots__ = ('_data', '_name', '_streetAddress', '_postalCode', '_city',
+                 '_country')
+
     def __init__(self, data):
-        self.name = data['shippingAddress.name'].decode('utf-8')
-        self.streetAddress = data['shippingAddress.streetAddress'].decode('utf-8')
-        self.postalCode = data['shippingAddress.postalCode'].decode('utf-8')
-        self.city = data['shippingAddress.city'].decode('utf-8')
-        self.country = data['shippingAddress.country'].decode('utf-8')
+        self._data = data
+
+    @_lazy
+    def name(self):
+        return self._data['shippingAddress.name'].decode('utf-8')
+
+    @_lazy
+    def streetAddress(self):
+        return self._data['shippingAddress.streetAddress'].decode('utf-8')
+
+    @_lazy
+    def postalCode(self):
+        return self._data['shippingAddress.postalCode'].decode('utf-8')
+
+    @_lazy
+    def city(self):
+        return self._data['shippingAddress.city'].decode('utf-8')
 
+    @_lazy
+    def country(self):
+        return self._data['shippingAddress.country'].decode('utf-8')
 
-class PaymentDetails(object):
+
+class PaymentDetails(_Slotted):
     """Holds the returned values from the payment_details and IPN callback operations.
 
     See https://api.payson.se/#PaymentDetailsrequest for a description of 
-    attributes.
+    attributes. Attributes that need decoding are decoded on first access,
+    shippingAddress is only available for payments having one.
     """
+    __slots__ = ('_data', 'purchaseId', 'token', 'senderEmail', 'status',
+                 'type', 'guaranteeStatus', '_guaranteeDeadlineTimestamp',
+                 'invoiceStatus', '_custom', '_trackingId', 'currencyCode',
+                 '_receiverFee', '_receiverList', '_shippingAddress')
+    _serial_kind = 'D'
+
     def __init__(self, data):
+        if not isinstance(data, ResponseData):
+            data = data.copy()
+        self._data = data
         self.purchaseId = data.get('purchaseId', '')
         self.token = data.get('token')
         self.senderEmail = data.get('senderEmail', '')
         self.status = data['status']
         self.type = data['type']
         self.guaranteeStatus = data.get('guaranteeStatus')
-        self.guaranteeDeadlineTimestamp = datetime.datetime.strptime(
-             data['guaranteeDeadlineTimestamp'], '%Y-%m-%dT%H:%M:%S') \
-             if 'guaranteeDeadlineTimestamp' in data else None
         self.invoiceStatus = data.get('invoiceStatus')
-        custom = data.get('custom')
-        self.custom = custom and json.loads(custom)
-        self.trackingId = data.get('trackingId', '').decode('utf-8')
         self.currencyCode = data['currencyCode']
-        self.receiverFee = decimal.Decimal(data.get('receiverFee', '0'))
-        self.receiverList = Receiver.from_response_data(data)
-        if 'shippingAddress.name' in data:
-            self.shippingAddress = ShippingAddress(data)
-        self.post_data = data.copy()
+
+    def __setstate__(self, state):
+        if 'post_data' in state:
+            # pickled before attributes were kept in slots
+            state['_data'] = state.pop('post_data')
+        super(PaymentDetails, self).__setstate__(state)
+
+    @_lazy
+    def guaranteeDeadlineTimestamp(self):
+        if 'guaranteeDeadlineTimestamp' not in self._data:
+            return None
+        return _parse_timestamp(self._data['guaranteeDeadlineTimestamp'])
+
+    @_lazy
+    def custom(self):
+        custom = self._data.get('custom')
+        return custom and json.loads(custom)
+
+    @_lazy
+    def trackingId(self):
+        return self._data.get('trackingId', '').decode('utf-8')
+
+    @_lazy
+    def receiverFee(self):
+        return _parse_decimal(self._data.get('receiverFee', '0'))
+
+    @_lazy
+    def receiverList(self):
+        return Receiver.from_response_data(self._data)
+
+    @_lazy
+    def shippingAddress(self):
+        if 'shippingAddress.name' not in self._data:
+            raise AttributeError('shippingAddress')
+        return ShippingAddress(self._data)
+
+    @property
+    def post_data(self):
+        """The data this instance was created from."""
+        return self._data
+
+    @property
+    def raw(self):
+        """The unaltered body if created from RawResponseData, else None."""
+        return getattr(self._data, 'raw', None)
+
+    def to_bytes(self):
+        """Compact, versioned serialization, e.g. for caches and queues.
+
+        Only the response fields are kept, from_bytes restores them without
+        parsing and attributes are decoded again when accessed. Much smaller
+        and faster than pickle.
+
+        :rtype: str
+        """
+        return _pack(self._serial_kind, _flatten(self._data))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Instance serialized by to_bytes
+
+        :type data: str
+        :raises ValueError: if data was not serialized from cls
+        """
+        return cls(_restore_response_data(_unpack(data, cls._serial_kind)))
 
     @property
     def amount(self):
@@ -398,9 +3171,12 @@ class PaymentDetailsResponse(PaymentDetails):
 
     This class contains PaymentDetails with a ResponseEnvelope.
     """
-    def __init__(self, data):
-        super(PaymentDetailsResponse, self).__init__(data)
-        self.responseEnvelope = ResponseEnvelope(data)
+    __slots__ = ('_responseEnvelope', )
+    _serial_kind = 'R'
+
+    @_lazy
+    def responseEnvelope(self):
+        return ResponseEnvelope(self._data)
 
     @property
     def success(self):
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for the Payson API, for tests and load tests
+
+Implements the Pay, PaymentDetails, PaymentUpdate, Validate and SendIPN
+actions in memory, with configurable latency and injected errors. Use it
+in-process through FakePaysonTransport or over HTTP with FakePaysonServer:
+
+    payson = payson_fake.FakePayson(latency=0.05, error_rate=0.01)
+    api = payson_api.PaysonApi(user_id, user_key,
+                               transport=payson_fake.FakePaysonTransport(payson))
+
+Copyright (c) 2012 Tomas Walch
+MIT-License, see LICENSE for details
+"""
+import BaseHTTPServer
+import collections
+import cStringIO
+import datetime
+import itertools
+import random
+import socket
+import SocketServer
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import uuid
+
+import payson_api
+
+
+class FakePayson(object):
+    """In-memory Payson keeping the state of the payments created.
+
+    Payments are created with status CREATED, call complete to simulate a
+    buyer finishing the payment. An IPN message is produced whenever a
+    payment with an ipnNotificationUrl changes status or on SendIPN. It is
+    passed to ipn_handler if given, and kept in outbox.
+
+    With max_payments, only that many of the latest payments and of the 
+    latest IPN messages are kept, older ones are unknown to PaymentDetails,
+    PaymentUpdate and Validate. This keeps memory bounded in long runs.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0,
+                 error_status=500, seed=None, ipn_handler=None,
+                 max_outbox=1000, max_payments=None):
+        """Constructor
+
+        :param latency: Seconds added to every request
+        :type latency: float
+        :param jitter: Max random seconds added on top of latency
+        :type jitter: float
+        :param error_rate: Probability that a request fails with
+                           error_status
+        :type error_rate: float
+        :param error_status: HTTP status of injected errors
+        :type error_status: int
+        :param seed: Seed for the random latency and errors
+        :param ipn_handler: Called with (ipnNotificationUrl, message)
+        :param max_outbox: IPN messages kept in outbox
+        :type max_outbox: int
+        :param max_payments: Payments and IPN messages kept, None for all
+        :type max_payments: int
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.ipn_handler = ipn_handler
+        self.outbox = collections.deque(maxlen=max_outbox)
+        self.max_payments = max_payments
+        self.payments = collections.OrderedDict()
+        self.requests = collections.Counter()
+        self._random = random.Random(seed)
+        self._purchase_ids = itertools.count(1)
+        self._failures = collections.deque()
+        self._sent_ipns = collections.OrderedDict()
+        self._undelivered = []
+        self._lock = threading.Lock()
+
+    def fail_next(self, count=1, status=503):
+        """Make the next count requests fail with status."""
+        with self._lock:
+            self._failures.extend([status] * count)
+
+    def handle(self, action, body, headers, timeout=None):
+        """Handle a request for action, e.g. 'Pay'.
+
+        :param timeout: Seconds the caller waits for the response
+        :type timeout: float
+        :returns: HTTP status and response body
+        :rtype: (int, str)
+        :raises socket.timeout: if latency exceeds timeout, the request is
+                                then not handled
+        """
+        with self._lock:
+            self.requests[action] += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            if self._failures:
+                status = self._failures.popleft()
+            elif self._random.random() < self.error_rate:
+                status = self.error_status
+            else:
+                status = None
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise socket.timeout('timed out')
+        if delay:
+            time.sleep(delay)
+        if status is not None:
+            return status, 'Injected error'
+        if action == 'Validate':
+            with self._lock:
+                verified = body in self._sent_ipns
+            return 200, 'VERIFIED' if verified else 'INVALID'
+        handler = getattr(self, '_' + action, None)
+        if handler is None:
+            return 404, 'Not found'
+        if not (headers.get('PAYSON-SECURITY-USERID') and
+                headers.get('PAYSON-SECURITY-PASSWORD')):
+            return 200, self._failure(520003, 'Authentication failed')
+        data = payson_api.decode_response(body)
+        with self._lock:
+            response = handler(data)
+        self._deliver_ipns()
+        return 200, response
+
+    def complete(self, token, status='COMPLETED'):
+        """Simulate the buyer finishing the payment.
+
+        Invoice payments become PENDING with invoiceStatus ORDERCREATED.
+        """
+        with self._lock:
+            payment = self.payments[token]
+            if payment['type'] == 'INVOICE':
+                payment['status'] = 'PENDING'
+                payment['invoiceStatus'] = 'ORDERCREATED'
+            else:
+                payment['status'] = status
+            self._notify(payment)
+        self._deliver_ipns()
+
+    def _Pay(self, data):
+        for field in ('returnUrl', 'cancelUrl', 'memo', 'senderEmail',
+                      'senderFirstName', 'senderLastName',
+                      'receiverList.receiver(0).email',
+                      'receiverList.receiver(0).amount'):
+            if field not in data:
+                return self._failure(520002, 'Missing parameter', field)
+        token = str(uuid.uuid4())
+        payment = {'token': token,
+                   'purchaseId': str(next(self._purchase_ids)),
+                   'senderEmail': data['senderEmail'],
+                   'status': 'CREATED',
+                   'type': 'TRANSFER',
+                   'currencyCode': data.get('currencyCode', 'SEK'),
+                   'receiverFee': '0.00'}
+        if 'INVOICE' in [v for k, v in data.items()
+                         if k.startswith('fundingList.')]:
+            payment['type'] = 'INVOICE'
+        for field in ('custom', 'trackingId', 'ipnNotificationUrl'):
+            if field in data:
+                payment[field] = data[field]
+        for key, value in data.items():
+            if key.startswith('receiverList.'):
+                payment[key] = value
+        self.payments[token] = payment
+        self._forget_oldest(self.payments)
+        return self._success(TOKEN=token)
+
+    def _PaymentDetails(self, data):
+        payment = self.payments.get(data.get('token'))
+        if payment is None:
+            return self._failure(520004, 'Payment not found', 'token')
+        fields = dict(payment)
+        fields.pop('ipnNotificationUrl', None)
+        return self._success(**fields)
+
+    def _PaymentUpdate(self, data):
+        payment = self.payments.get(data.get('token'))
+        if payment is None:
+            return self._failure(520004, 'Payment not found', 'token')
+        transitions = {
+            ('INVOICE', 'ORDERCREATED', 'SHIPORDER'): 'SHIPPED',
+            ('INVOICE', 'ORDERCREATED', 'CANCELORDER'): 'CANCELED',
+            ('INVOICE', 'SHIPPED', 'CREDITORDER'): 'CREDITED',
+            ('TRANSFER', 'COMPLETED', 'REFUND'): 'CREDITED'}
+        state = payment.get('invoiceStatus', payment['status'])
+        new_state = transitions.get((payment['type'], state,
+                                     data.get('action')))
+        if new_state is None:
+            return self._failure(580001, 'Invalid action for payment',
+                                 'action')
+        if payment['type'] == 'INVOICE':
+            payment['invoiceStatus'] = new_state
+        else:
+            payment['status'] = new_state
+        self._notify(payment)
+        return self._success()
+
+    def _SendIPN(self, data):
+        payment = self.payments.get(data.get('token'))
+        if payment is None:
+            return self._failure(520004, 'Payment not found', 'token')
+        self._notify(payment)
+        return self._success()
+
+    def _notify(self, payment):
+        url = payment.get('ipnNotificationUrl')
+        if not url:
+            return
+        fields = dict(payment)
+        del fields['ipnNotificationUrl']
+        message = urllib.urlencode(sorted(fields.items()))
+        self._sent_ipns.pop(message, None)
+        self._sent_ipns[message] = None
+        self._forget_oldest(self._sent_ipns)
+        self.outbox.append((url, message))
+        self._undelivered.append((url, message))
+
+    def _forget_oldest(self, items):
+        if self.max_payments is not None and len(items) > self.max_payments:
+            items.popitem(last=False)
+
+    def _deliver_ipns(self):
+        # outside the lock, the handler may well call Validate
+        with self._lock:
+            undelivered, self._undelivered = self._undelivered, []
+        if self.ipn_handler is not None:
+            for url, message in undelivered:
+                self.ipn_handler(url, message)
+
+    def _success(self, **fields):
+        fields.update(self._envelope('SUCCESS'))
+        return urllib.urlencode(fields)
+
+    def _failure(self, error_id, message, parameter=None):
+        fields = self._envelope('FAILURE')
+        fields['errorList.error(0).errorId'] = str(error_id)
+        fields['errorList.error(0).message'] = message
+        if parameter:
+            fields['errorList.error(0).parameter'] = parameter
+        return urllib.urlencode(fields)
+
+    def _envelope(self, ack):
+        return {'responseEnvelope.ack': ack,
+                'responseEnvelope.timestamp':
+                    datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+                'responseEnvelope.correlationId': str(uuid.uuid4())}
+
+
+def _action(url):
+    """'https://api.payson.se/1.0/Pay/' -> 'Pay'"""
+    return urlparse.urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]
+
+
+class FakePaysonTransport(payson_api.Transport):
+    """Transport answering requests from a FakePayson in-process."""
+
+    def __init__(self, payson=None):
+        self.payson = payson if payson is not None else FakePayson()
+
+    def send(self, url, body, headers, timings=None, timeout=None):
+        start = time.time()
+        try:
+            status, data = self.payson.handle(_action(url), body, headers,
+                                              timeout)
+        except socket.timeout, e:
+            raise urllib2.URLError(e)
+        if timings is not None:
+            timings['wait'] = time.time() - start
+        if not 200 <= status < 300:
+            raise urllib2.HTTPError(url, status, 'Fake Payson error', {},
+                                    cStringIO.StringIO(data))
+        return data
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        headers = dict((k.upper(), v) for k, v in self.headers.items())
+        status, data = self.server.payson.handle(_action(self.path), body,
+                                                 headers)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class FakePaysonServer(object):
+    """Serves a FakePayson over HTTP from a background thread.
+
+    Pass url as endpoint to PaysonApi. Can be used as a context manager.
+    """
+    def __init__(self, payson=None, host='127.0.0.1', port=0):
+        self.payson = payson if payson is not None else FakePayson()
+        self._server = _Server((host, port), _Handler)
+        self._server.payson = self.payson
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self._server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
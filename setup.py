@@ -3,7 +3,7 @@ from distutils.core import setup
 setup(
     name='payson_api',
     version='1.0',
-    py_modules=['payson_api'],
+    py_modules=['payson_api', 'payson_fake'],
     url='https://github.com/tjwalch/python-payson',
     download_url='https://github.com/tjwalch/python-payson/tarball/1.0',
     license='MIT',
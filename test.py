@@ -1,12 +1,25 @@
 # -*- coding: utf-8 -*-
+import BaseHTTPServer
+import collections
+import cStringIO
+import csv
 import datetime
 import decimal
+import json
+import os
+import pickle
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
 import urllib2
 import urlparse
 
 import mechanize
 
 import payson_api
+import payson_fake
 
 PAYSON_AGENT_ID = '1'
 PAYSON_AGENT_KEY = 'fddb19ac-7470-42b6-a91d-072cb1495f0a'
@@ -19,6 +32,19 @@ receiver = payson_api.Receiver(email='testagent-1@payson.se',
                            primary=False)
 
 
+def _pay(api, **kwargs):
+    """api.pay with the fields of a test payment, kwargs add or replace."""
+    fields = dict(returnUrl=return_url,
+                  cancelUrl=cancel_url,
+                  memo=u'test memo',
+                  senderEmail='test-shopper@payson.se',
+                  senderFirstName=u'Tester',
+                  senderLastName=u'Räksmörgås',
+                  receiverList=[receiver, ])
+    fields.update(kwargs)
+    return api.pay(**fields)
+
+
 def test_pay_transfer():
     custom = ['list', 'of', 'custom', 'things', u'åäö']
     api = payson_api.PaysonApi(PAYSON_AGENT_ID,
@@ -152,3 +178,1038 @@ def test_pay_invoice():
     assert r4.success
     assert r4.status == 'PENDING', r4.status
     assert r4.invoiceStatus == 'SHIPPED', r4.invoiceStatus
+
+
+PAYMENT_DETAILS_BODY = (
+    'responseEnvelope.ack=SUCCESS'
+    '&responseEnvelope.timestamp=2014-03-01T12%3A30%3A05'
+    '&responseEnvelope.correlationId=1234'
+    '&purchaseId=42&token=TOKEN&senderEmail=test-shopper%40payson.se'
+    '&status=COMPLETED&type=TRANSFER&currencyCode=SEK&receiverFee=6.75'
+    '&custom=%5B%22list%22%5D&trackingId=%C3%85%C3%84%C3%96'
+    '&receiverList.receiver(0).email=testagent-1%40payson.se'
+    '&receiverList.receiver(0).amount=125.00'
+    '&receiverList.receiver(0).primary=false')
+
+
+def _stub_server(response_body, status=200, keep_alive=True):
+    """Start a local keep-alive HTTP server.
+
+    response_body is either the body returned for every POST or a function
+    of the request path and body returning (status, response body), or None
+    to close the connection without answering. Without keep_alive the
+    connection is closed after every response, without telling the client.
+    """
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        wbufsize = -1
+
+        def do_POST(self):
+            request_body = self.rfile.read(int(self.headers['Content-Length']))
+            self.server.requests.append((self.path, request_body))
+            if callable(response_body):
+                response = response_body(self.path, request_body)
+                if response is None:
+                    self.close_connection = 1
+                    return
+                code, body = response
+            else:
+                code, body = status, response_body
+            self.send_response(code)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            if not keep_alive:
+                self.close_connection = 1
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
+def test_connection_pool_reuses_connections():
+    server, url = _stub_server('VERIFIED')
+    try:
+        api = payson_api.PaysonApi(PAYSON_AGENT_ID, PAYSON_AGENT_KEY)
+        api.validate_ipn_cmd = url + '/1.0/Validate/'
+        for i in range(5):
+            assert api.validate('token=abc')
+        assert len(server.requests) == 5
+        assert api.transport.pool.connections_opened == 1
+        api.close()
+    finally:
+        server.shutdown()
+
+
+def test_connection_pool_never_resends():
+    # a connection closed while idle is replaced before use
+    server, url = _stub_server('VERIFIED', keep_alive=False)
+    try:
+        api = payson_api.PaysonApi(PAYSON_AGENT_ID, PAYSON_AGENT_KEY)
+        api.validate_ipn_cmd = url + '/1.0/Validate/'
+        assert api.validate('token=abc')
+        time.sleep(0.1)
+        assert api.validate('token=abc')
+        assert len(server.requests) == 2
+        assert api.transport.pool.connections_opened == 2
+    finally:
+        server.shutdown()
+
+    # a request lost after it was sent is not sent again
+    answers = iter([(200, 'VERIFIED'), None])
+    server, url = _stub_server(lambda path, body: next(answers))
+    try:
+        api = payson_api.PaysonApi(PAYSON_AGENT_ID, PAYSON_AGENT_KEY)
+        api.validate_ipn_cmd = url + '/1.0/Validate/'
+        assert api.validate('token=abc')
+        try:
+            api.validate('token=abc')
+        except urllib2.URLError:
+            pass
+        else:
+            assert False, 'URLError not raised'
+        assert len(server.requests) == 2
+    finally:
+        server.shutdown()
+
+
+def test_connection_pool_http_error():
+    server, url = _stub_server('Unavailable', status=503)
+    try:
+        api = payson_api.PaysonApi(PAYSON_AGENT_ID, PAYSON_AGENT_KEY)
+        api.validate_ipn_cmd = url + '/1.0/Validate/'
+        try:
+            api.validate('token=abc')
+        except urllib2.HTTPError, e:
+            assert e.code == 503
+        else:
+            assert False, 'HTTPError not raised'
+    finally:
+        server.shutdown()
+
+
+def test_async_api():
+    server, url = _stub_server('VERIFIED')
+    try:
+        api = payson_api.AsyncPaysonApi(PAYSON_AGENT_ID, PAYSON_AGENT_KEY,
+                                        workers=4, endpoint=url)
+        results = [api.validate('token=%d' % i) for i in range(20)]
+        assert all(result.get(timeout=10) for result in results)
+        assert len(server.requests) == 20
+        assert api.transport.pool.connections_opened <= 4
+        assert not isinstance(api, payson_api.PaysonApi)
+        assert api.api.validate('token=abc') is True
+        api.close()
+    finally:
+        server.shutdown()
+
+
+def test_payment_details_many():
+    def respond(path, request_body):
+        token = urlparse.parse_qs(request_body)['token'][0]
+        if token == 'bad':
+            return 500, 'Internal Server Error'
+        return 200, PAYMENT_DETAILS_BODY.replace('TOKEN', token)
+
+    server, url = _stub_server(respond)
+    try:
+        api = payson_api.PaysonApi(PAYSON_AGENT_ID, PAYSON_AGENT_KEY)
+        api.get_payment_details_cmd = url + '/1.0/PaymentDetails/'
+        tokens = ['t%d' % i for i in range(20)] + ['bad']
+        results = dict(api.payment_details_many(iter(tokens),
+                                                max_concurrency=3))
+        assert sorted(results) == sorted(tokens)
+        assert isinstance(results['bad'], urllib2.HTTPError)
+        assert results['t7'].token == 't7'
+        assert results['t7'].status == 'COMPLETED'
+        assert api.transport.pool.connections_opened <= 3
+        api.close()
+    finally:
+        server.shutdown()
+
+
+def test_payment_details_cache():
+    def respond(path, request_body):
+        if path.endswith('/Validate/'):
+            return 200, 'VERIFIED'
+        return 200, PAYMENT_DETAILS_BODY
+
+    server, url = _stub_server(respond)
+    try:
+        cache = payson_api.PaymentDetailsCache(maxsize=2, ttl=60)
+        api = payson_api.PaysonApi(PAYSON_AGENT_ID, PAYSON_AGENT_KEY,
+                                   cache=cache)
+        api.get_payment_details_cmd = url + '/1.0/PaymentDetails/'
+        api.update_payment_details_cmd = url + '/1.0/PaymentUpdate/'
+        api.validate_ipn_cmd = url + '/1.0/Validate/'
+        first = api.payment_details('a')
+        assert api.payment_details('a') is first
+        assert (cache.hits, cache.misses) == (1, 1)
+        api.payment_details('b')
+        api.payment_details('c')
+        assert len(cache) == 2
+        api.payment_details('a')
+        assert cache.misses == 4
+        assert api.validate('token=a&status=COMPLETED')
+        assert cache.get('a') is None
+        api.payment_details('c')
+        assert api.payment_update('c', 'SHIPORDER')
+        assert cache.get('c') is None
+        assert len(server.requests) == 6
+        api.close()
+    finally:
+        server.shutdown()
+
+    # details fetched before their token was invalidated are not cached,
+    # others are
+    details = payson_api.PaymentDetailsResponse(
+        payson_api.decode_response(PAYMENT_DETAILS_BODY))
+    cache = payson_api.PaymentDetailsCache(maxsize=2)
+    started = cache.invalidations
+    cache.invalidate('a')
+    cache.put('a', details, started)
+    cache.put('b', details, started)
+    assert cache.get('a') is None and cache.get('b') is details
+    cache.put('a', details, cache.invalidations)
+    assert cache.get('a') is details
+    for token in 'cde':
+        cache.invalidate(token)
+    cache.put('f', details, started)
+    assert cache.get('f') is None
+
+
+def test_decode_response():
+    body = (PAYMENT_DETAILS_BODY +
+            '&receiverList.receiver(1).email=b%40example.com'
+            '&receiverList.receiver(1).amount=10&receiverList.receiver(3).'
+            'email=gap%40example.com&errorList.error(0).errorId=590001'
+            '&errorList.error(0).message=a+message&status=DUPLICATE&empty='
+            '&noequals&semi=colon;other=value')
+    data = payson_api.decode_response(body)
+    assert data == dict((k, v[0]) for k, v in urlparse.parse_qs(body).items())
+    assert [r.email for r in payson_api.Receiver.from_response_data(data)] \
+        == ['testagent-1@payson.se', 'b@example.com']
+    errors = payson_api.Error.from_response_dict(data)
+    assert errors[0].errorId == 590001
+    assert errors[0].message == 'a message'
+    details = payson_api.PaymentDetailsResponse(data)
+    assert details.amount == decimal.Decimal('135')
+    assert details.receiverList[0].primary is False
+    assert details.trackingId == u'ÅÄÖ'
+
+
+def test_raw_response_data():
+    bodies = [PAYMENT_DETAILS_BODY,
+              PAYMENT_DETAILS_BODY.replace('purchaseId=42', 'purchaseId=43'),
+              'a=1&a=2&b=&c&d=x+y%21;e=%C3%85&errorList.error%280%29.'
+              'errorId=520002&errorList.error(0).message=M&=v']
+    for body in bodies:
+        data = payson_api.RawResponseData(body)
+        decoded = payson_api.decode_response(body)
+        assert data == decoded and dict(data.items()) == decoded
+        assert data.groups == decoded.groups
+        assert data.raw is body
+        assert 'b' not in data and data.get('b') is None
+    assert payson_api.RawResponseData(bodies[0])._layout is \
+        payson_api.RawResponseData(bodies[1])._layout
+    data = payson_api.RawResponseData(bodies[2])
+    assert data['d'] == 'x y!' and data['a'] == '1'
+    assert payson_api.Error.from_response_dict(data)[0].errorId == 520002
+
+    details = payson_api.PaymentDetailsResponse(
+        payson_api.RawResponseData(PAYMENT_DETAILS_BODY))
+    reference = payson_api.PaymentDetailsResponse(
+        payson_api.decode_response(PAYMENT_DETAILS_BODY))
+    assert details.raw is PAYMENT_DETAILS_BODY and reference.raw is None
+    for name in ('status', 'token', 'senderEmail', 'trackingId', 'custom',
+                 'receiverFee', 'amount', 'success'):
+        assert getattr(details, name) == getattr(reference, name)
+    restored = pickle.loads(pickle.dumps(details, 2))
+    assert restored.raw == PAYMENT_DETAILS_BODY
+    assert restored.receiverList[0].email == 'testagent-1@payson.se'
+    restored = payson_api.PaymentDetailsResponse.from_bytes(details.to_bytes())
+    assert restored.post_data == details.post_data
+
+    payson = payson_fake.FakePayson()
+    api = payson_api.PaysonApi(
+        PAYSON_AGENT_ID, PAYSON_AGENT_KEY, keep_raw=True,
+        transport=payson_fake.FakePaysonTransport(payson))
+    ipns = []
+    payson.ipn_handler = lambda url, message: ipns.append(message)
+    token = _pay(api, ipnNotificationUrl='http://localhost/ipn').token
+    assert isinstance(api.payment_details(token).post_data,
+                      payson_api.RawResponseData)
+    payson.complete(token)
+    ipn = payson_api.PaymentDetails(payson_api.RawResponseData(ipns[-1]))
+    assert ipn.status == 'COMPLETED' and api.validate(ipn)
+    for message in (reference, payson_api.decode_response(ipns[-1])):
+        try:
+            api.validate(message)
+        except ValueError:
+            pass
+        else:
+            assert False, 'ValueError not raised'
+
+
+def test_payment_details_lazy_attributes():
+    body = (PAYMENT_DETAILS_BODY + '&shippingAddress.name=%C3%85ke'
+            '&shippingAddress.streetAddress=Gatan+1'
+            '&shippingAddress.postalCode=12345'
+            '&shippingAddress.city=Stockholm&shippingAddress.country=SE')
+    details = payson_api.PaymentDetailsResponse(
+        payson_api.decode_response(body))
+    assert not hasattr(details, '__dict__')
+    assert details.receiverFee == decimal.Decimal('6.75')
+    details.custom = 'changed'
+    for protocol in (0, 2):
+        copy = pickle.loads(pickle.dumps(details, protocol))
+        assert copy.custom == 'changed'
+        assert copy.shippingAddress.name == u'Åke'
+        assert copy.responseEnvelope.timestamp == \
+            datetime.datetime(2014, 3, 1, 12, 30, 5)
+        assert copy.post_data['status'] == 'COMPLETED'
+    plain = payson_api.PaymentDetails(payson_api.decode_response(
+        PAYMENT_DETAILS_BODY))
+    assert not hasattr(plain, 'shippingAddress')
+    assert plain.guaranteeDeadlineTimestamp is None
+
+
+def test_timestamp_and_decimal_parsing():
+    for value in ('2014-03-01T12:30:05', '1999-12-31T23:59:59',
+                  '2016-02-29T00:00:00'):
+        parsed = payson_api._parse_timestamp(value)
+        assert parsed == datetime.datetime.strptime(value,
+                                                    '%Y-%m-%dT%H:%M:%S')
+        assert payson_api._parse_timestamp(value) is parsed
+    for value in ('2014-02-30T12:30:05', '2014-03-01 12:30:05',
+                  '2014-03-01T12:30:+5', ''):
+        try:
+            payson_api._parse_timestamp(value)
+        except ValueError:
+            pass
+        else:
+            assert False, 'ValueError not raised for %r' % value
+    assert str(payson_api._parse_decimal('125.00')) == '125.00'
+    assert payson_api._parse_decimal('6.75') is \
+        payson_api._parse_decimal('6.75')
+    assert str(payson_api._parse_decimal(125)) == '125'
+    assert str(payson_api.Receiver('a@example.com', 125).amount) == '125'
+
+    # receivers built for pay check the amount at once and take attributes
+    # of your own
+    try:
+        payson_api.Receiver('a@example.com', 'lots')
+    except decimal.InvalidOperation:
+        pass
+    else:
+        assert False, 'InvalidOperation not raised'
+    mine = payson_api.Receiver('a@example.com', '10.50')
+    mine.note = u'partner'
+    copy = pickle.loads(pickle.dumps(mine, 2))
+    assert (copy.note, copy.amount) == (u'partner', decimal.Decimal('10.50'))
+
+
+def test_serialization():
+    body = PAYMENT_DETAILS_BODY.replace(
+        'receiverFee', 'shippingAddress.name=Anna%00&receiverFee')
+    details = payson_api.PaymentDetailsResponse(
+        payson_api.decode_response(body))
+    details.receiverList
+    for instance in (details, payson_api.PaymentDetails(details.post_data)):
+        data = instance.to_bytes()
+        assert data.startswith('PS\x01')
+        restored = type(instance).from_bytes(data)
+        assert type(restored) is type(instance)
+        assert restored.post_data == instance.post_data
+        assert restored.post_data.groups == instance.post_data.groups
+        assert restored.amount == instance.amount
+        assert restored.shippingAddress.name == u'Anna\x00'
+    restored = payson_api.PaymentDetailsResponse.from_bytes(
+        payson_api.PaymentDetailsResponse(
+            payson_api.decode_response(PAYMENT_DETAILS_BODY)).to_bytes())
+    assert len(restored.to_bytes()) < len(PAYMENT_DETAILS_BODY)
+    assert restored.responseEnvelope.success
+    assert restored.receiverList[0].amount == decimal.Decimal('125.00')
+
+    pay_response = payson_api.PayResponse(
+        payson_api.PAYSON_WWW_PAY_FORWARD_URL,
+        payson_api.decode_response(
+            'responseEnvelope.ack=SUCCESS&TOKEN=abc'
+            '&responseEnvelope.correlationId=1'
+            '&responseEnvelope.timestamp=2012-01-01T12%3A00%3A00'))
+    restored = payson_api.PayResponse.from_bytes(pay_response.to_bytes())
+    assert restored.token == 'abc' and restored.success
+    assert restored.forward_pay_url == pay_response.forward_pay_url
+    for data, kind in ((pay_response.to_bytes(), payson_api.PaymentDetails),
+                       ('PS\x02D', payson_api.PaymentDetails),
+                       ('junk', payson_api.PayResponse)):
+        try:
+            kind.from_bytes(data)
+        except ValueError:
+            pass
+        else:
+            assert False, 'ValueError not raised'
+
+
+def test_pay_request_encoding():
+    server, url = _stub_server('responseEnvelope.ack=SUCCESS'
+                               '&responseEnvelope.timestamp=2014-03-01T12'
+                               '%3A30%3A05&responseEnvelope.correlationId=1'
+                               '&TOKEN=abc')
+    try:
+        api = payson_api.PaysonApi(PAYSON_AGENT_ID, PAYSON_AGENT_KEY)
+        api.pay_cmd = url + '/1.0/Pay/'
+        r = _pay(api,
+                 memo=u'test & memo',
+                 custom={'a': 1},
+                 fundingList=['BANK', 'CREDITCARD'],
+                 trackingId=u'ÅÄÖ',
+                 orderItemList=[payson_api.OrderItem(u'item %d' % i, i,
+                                                     1, 5, '0.25')
+                                for i in range(12)],
+                 showReceiptPage=False)
+        assert r.forward_pay_url.endswith('abc')
+        path, body = server.requests[0]
+        fields = urlparse.parse_qs(body)
+        assert all(len(v) == 1 for v in fields.values())
+        fields = dict((k, v[0]) for k, v in fields.items())
+        assert fields['memo'] == 'test & memo'
+        assert fields['senderLastName'] == u'Räksmörgås'.encode('utf-8')
+        assert fields['receiverList.receiver(0).firstName'] == \
+            u'Åke'.encode('utf-8')
+        assert fields['receiverList.receiver(0).primary'] == 'false'
+        assert fields['fundingList.fundingConstraint(1).constraint'] == \
+            'CREDITCARD'
+        assert fields['orderItemList.orderItem(11).description'] == 'item 11'
+        assert fields['custom'] == '{"a": 1}'
+        assert fields['showReceiptPage'] == 'false'
+        assert len(fields) == 16 + 5 * 12
+    finally:
+        server.shutdown()
+
+
+def test_ipn_processor():
+    def respond(path, request_body):
+        if 'broken' in request_body:
+            return 200, 'SOMETHING ELSE'
+        if 'status=COMPLETED' in request_body:
+            return 200, 'VERIFIED'
+        return 200, 'INVALID'
+
+    server, url = _stub_server(respond)
+    try:
+        api = payson_api.PaysonApi(PAYSON_AGENT_ID, PAYSON_AGENT_KEY)
+        api.validate_ipn_cmd = url + '/1.0/Validate/'
+        received = []
+        processor = payson_api.IpnProcessor(api, workers=3, max_queue=5)
+        processor.add_handler(received.append)
+        assert processor.submit('token=t0&status=COMPLETED', block=False)
+        assert processor.stats()['queued'] == 1
+        processor.start()
+        base = 'type=TRANSFER&currencyCode=SEK&token=t%d'
+        for i in range(20):
+            processor.submit(base % i + '&status=COMPLETED')
+        processor.submit(base % 20 + '&status=FAKED')
+        processor.submit(base % 21 + '&status=broken')
+        processor.join()
+        processor.stop()
+        stats = processor.stats()
+        assert stats['dispatched'] == 20
+        assert stats['verified'] == 21
+        assert stats['invalid'] == 1
+        assert stats['failed'] == 2
+        assert sorted(d.token for d in received) == \
+            sorted('t%d' % i for i in range(20))
+        reasons = [letter.reason for letter in processor.dead_letters]
+        assert 'INVALID' in reasons
+        assert any(isinstance(r, ValueError) for r in reasons)
+        assert any(isinstance(r, KeyError) for r in reasons)
+
+        # validation must block, an AsyncResult would always be true
+        api = payson_api.AsyncPaysonApi(PAYSON_AGENT_ID, PAYSON_AGENT_KEY,
+                                        endpoint=url)
+        try:
+            payson_api.IpnProcessor(api, [received.append])
+        except TypeError:
+            pass
+        else:
+            assert False, 'TypeError not raised'
+        processor = payson_api.IpnProcessor(api.api, [received.append])
+        processor.start()
+        processor.submit(base % 22 + '&status=FAKED')
+        processor.join()
+        processor.stop()
+        assert processor.invalid == 1 and processor.dispatched == 0
+    finally:
+        server.shutdown()
+
+
+def test_ipn_deduplication():
+    server, url = _stub_server('VERIFIED')
+    try:
+        api = payson_api.PaysonApi(PAYSON_AGENT_ID, PAYSON_AGENT_KEY)
+        api.validate_ipn_cmd = url + '/1.0/Validate/'
+        deduplicator = payson_api.IpnDeduplicator(window=60)
+        received = []
+        processor = payson_api.IpnProcessor(api, [received.append],
+                                            deduplicator=deduplicator)
+        processor.start()
+        message = 'type=TRANSFER&currencyCode=SEK&status=COMPLETED&token=t%d'
+        for i in range(10):
+            processor.submit(message % (i % 4))
+        processor.join()
+        processor.stop()
+        assert len(received) == 4
+        assert processor.duplicates == 6
+        assert len(server.requests) == 4
+        assert deduplicator.hit_ratio == 0.6
+        deduplicator.release(message % 0)
+        assert deduplicator.claim(message % 0)
+
+        # messages that failed are processed again when repeated
+        failures = [ValueError('handler failed')]
+
+        def fail_once(details):
+            if failures:
+                raise failures.pop()
+
+        processor = payson_api.IpnProcessor(api, [fail_once, received.append],
+                                            deduplicator=deduplicator)
+        processor.start()
+        processor.submit(message % 5)
+        processor.join()
+        processor.submit(message % 5)
+        processor.join()
+        processor.stop()
+        assert processor.failed == 1
+        assert processor.duplicates == 0
+        assert processor.dispatched == 1
+        assert received[-1].token == 't5'
+    finally:
+        server.shutdown()
+
+
+def _fake_flow(api, payson):
+    ipns = []
+    payson.ipn_handler = lambda url, message: ipns.append(message)
+    r = _pay(api,
+             fundingList=['INVOICE'],
+             ipnNotificationUrl='http://localhost/ipn',
+             trackingId=u'ÅÄÖ')
+    assert r.success
+    assert api.payment_details(r.token).status == 'CREATED'
+    payson.complete(r.token)
+    assert api.validate(ipns[-1])
+    assert not api.validate(ipns[-1] + '&status=COMPLETED')
+    details = payson_api.PaymentDetails(payson_api.decode_response(ipns[-1]))
+    assert details.invoiceStatus == 'ORDERCREATED'
+    assert details.trackingId == u'ÅÄÖ'
+    assert details.amount == 125
+    assert api.payment_update(r.token, 'SHIPORDER')
+    assert not api.payment_update(r.token, 'SHIPORDER')
+    assert api.payment_details(r.token).invoiceStatus == 'SHIPPED'
+    assert len(ipns) == 2
+
+
+def test_fake_payson_transport():
+    payson = payson_fake.FakePayson()
+    api = payson_api.PaysonApi(
+        PAYSON_AGENT_ID, PAYSON_AGENT_KEY,
+        transport=payson_fake.FakePaysonTransport(payson))
+    _fake_flow(api, payson)
+    payson.fail_next(status=503)
+    try:
+        api.payment_details('any')
+    except urllib2.HTTPError, e:
+        assert e.code == 503
+    else:
+        assert False, 'HTTPError not raised'
+
+    # transports taking only url, body and headers still work
+    class PlainTransport(payson_api.Transport):
+        def send(self, url, body, headers):
+            status, data = payson.handle(payson_fake._action(url), body,
+                                         headers)
+            return data
+
+    api = payson_api.PaysonApi(PAYSON_AGENT_ID, PAYSON_AGENT_KEY,
+                               transport=PlainTransport(), timeout=5)
+    api.add_listener(payson_api.MetricsListener())
+    _fake_flow(api, payson)
+
+
+def test_retry_and_circuit_breaker():
+    payson = payson_fake.FakePayson()
+    breaker = payson_api.CircuitBreaker(failure_threshold=3,
+                                        reset_timeout=0.05)
+    api = payson_api.PaysonApi(
+        PAYSON_AGENT_ID, PAYSON_AGENT_KEY,
+        transport=payson_fake.FakePaysonTransport(payson),
+        retry=payson_api.RetryPolicy(attempts=3, backoff=0.001),
+        circuit_breaker=breaker)
+    token = _pay(api).token
+    payson.fail_next(2, status=503)
+    assert api.payment_details(token).status == 'CREATED'
+    assert payson.requests['PaymentDetails'] == 3
+    assert breaker.state == 'closed'
+
+    payson.fail_next(1, status=503)
+    try:
+        api.payment_update(token, 'SHIPORDER')
+    except urllib2.HTTPError, e:
+        assert e.code == 503
+    else:
+        assert False, 'HTTPError not raised'
+    assert payson.requests['PaymentUpdate'] == 1
+    assert breaker.failures == 1
+    api.payment_details(token)
+    assert breaker.failures == 0
+
+    payson.fail_next(3, status=500)
+    for error in (urllib2.HTTPError, payson_api.CircuitOpenError):
+        try:
+            api.payment_details(token)
+        except error:
+            pass
+        else:
+            assert False, '%s not raised' % error.__name__
+    assert payson.requests['PaymentDetails'] == 7
+    assert breaker.state == 'open'
+    time.sleep(0.06)
+    assert breaker.state == 'half-open'
+    assert api.payment_details(token).status == 'CREATED'
+    assert breaker.state == 'closed'
+
+
+def test_deadline_and_hedging():
+    slow = []
+
+    def respond(path, body):
+        if not slow:
+            slow.append(path)
+            time.sleep(0.5)
+        return 200, PAYMENT_DETAILS_BODY
+
+    server, url = _stub_server(respond)
+    try:
+        hedge = payson_api.HedgePolicy(initial_delay=0.05)
+        api = payson_api.PaysonApi(PAYSON_AGENT_ID, PAYSON_AGENT_KEY,
+                                   endpoint=url, hedge=hedge)
+        start = time.time()
+        assert api.payment_details('abc').status == 'COMPLETED'
+        assert time.time() - start < 0.4
+        assert hedge.hedges == 1 and len(server.requests) == 2
+        # The slow request that lost to the hedge is observed as well
+        time.sleep(0.6)
+        hedge.min_samples, hedge.percentile = 2, 100
+        assert hedge.delay() >= 0.5
+
+        del slow[:]
+        api.hedge = None
+        start = time.time()
+        try:
+            api.payment_details('abc', timeout=0.1)
+        except payson_api.DeadlineExceeded:
+            assert time.time() - start < 0.4
+        else:
+            assert False, 'DeadlineExceeded not raised'
+        api.close()
+    finally:
+        server.shutdown()
+
+    # waiting for a free slot counts against the time budget
+    payson = payson_fake.FakePayson()
+    api = payson_api.PaysonApi(
+        PAYSON_AGENT_ID, PAYSON_AGENT_KEY, max_concurrency=1,
+        transport=payson_fake.FakePaysonTransport(payson))
+    token = _pay(api).token
+    payson.latency = 0.5
+    busy = threading.Thread(target=api.payment_details, args=(token, ))
+    busy.start()
+    time.sleep(0.05)
+    start = time.time()
+    try:
+        api.payment_details(token, timeout=0.1)
+    except payson_api.DeadlineExceeded:
+        assert time.time() - start < 0.3
+    else:
+        assert False, 'DeadlineExceeded not raised'
+    busy.join()
+    assert payson.requests['PaymentDetails'] == 1
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.005)
+
+
+def test_status_poller():
+    payson = payson_fake.FakePayson()
+    api = payson_api.PaysonApi(
+        PAYSON_AGENT_ID, PAYSON_AGENT_KEY,
+        transport=payson_fake.FakePaysonTransport(payson))
+    tokens = [_pay(api, fundingList=funding).token
+              for funding in (['BANK'], ['INVOICE'])]
+    transitions = []
+    seen = []
+    poller = payson_api.StatusPoller(api, first_interval=0.01,
+                                     default_interval=0.01, max_interval=0.05)
+    poller.intervals = {'CREATED': 0.01}
+    poller.add_handler(lambda previous, details: transitions.append(
+        (previous and previous.status, details.status,
+         details.invoiceStatus)))
+    poller.start()
+    try:
+        for token in tokens:
+            poller.track(token, lambda previous, details: seen.append(details))
+        poller.track(tokens[0], lambda previous, details: seen.append(details))
+        _wait_for(lambda: len(seen) == 3)
+        assert len(set(id(details) for details in seen)) == 2
+
+        payson.complete(tokens[0])
+        payson.complete(tokens[1])
+        _wait_for(lambda: poller.pending == 1)
+        assert transitions.count(('CREATED', 'COMPLETED', None)) == 1
+        _wait_for(lambda: ('CREATED', 'PENDING', 'ORDERCREATED')
+                  in transitions)
+
+        polls = payson.requests['PaymentDetails']
+        assert api.payment_update(tokens[1], 'CANCELORDER')
+        poller.update(api.payment_details(tokens[1]))
+        assert poller.pending == 0
+        assert transitions[-1] == ('PENDING', 'PENDING', 'CANCELED')
+        time.sleep(0.1)
+        assert payson.requests['PaymentDetails'] <= polls + 2
+        assert poller.stats()['finished'] == 2
+        assert poller.stats()['transitions'] == 5
+    finally:
+        poller.stop()
+    poller.stop()
+
+    # polls must block, an AsyncPaysonApi is refused
+    try:
+        payson_api.StatusPoller(payson_api.AsyncPaysonApi(
+            PAYSON_AGENT_ID, PAYSON_AGENT_KEY,
+            transport=payson_fake.FakePaysonTransport(payson)))
+    except TypeError:
+        pass
+    else:
+        assert False, 'TypeError not raised'
+    payson_api.StatusPoller(api).stop()
+
+
+def test_merchant_registry():
+    class CountingTransport(payson_api.PooledTransport):
+        def __init__(self):
+            payson_api.PooledTransport.__init__(self)
+            self.users = []
+            self.in_flight = collections.Counter()
+            self.max_in_flight = collections.Counter()
+            self.lock = threading.Lock()
+
+        def send(self, url, body, headers, timings=None, timeout=None):
+            user_id = headers['PAYSON-SECURITY-USERID']
+            with self.lock:
+                self.users.append(user_id)
+                self.in_flight[user_id] += 1
+                self.max_in_flight[user_id] = max(
+                    self.max_in_flight[user_id], self.in_flight[user_id])
+            try:
+                return payson_api.PooledTransport.send(
+                    self, url, body, headers, timings, timeout)
+            finally:
+                with self.lock:
+                    self.in_flight[user_id] -= 1
+
+    with payson_fake.FakePaysonServer(
+            payson_fake.FakePayson(latency=0.02)) as server:
+        transport = CountingTransport()
+        registry = payson_api.MerchantRegistry(
+            transport=transport, endpoint=server.url, max_concurrency=2)
+        first = registry.add('m1', 'key1')
+        second = registry.get('m2', 'key2')
+        assert registry.get('m2') is second and len(registry) == 2
+        assert second.pay_cmd is first.pay_cmd
+        try:
+            registry.get('m3')
+        except KeyError:
+            pass
+        else:
+            assert False, 'KeyError not raised'
+        clients = []
+        threads = [threading.Thread(
+            target=lambda: clients.append(registry.get('m3', 'key3')))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(set(map(id, clients))) == 1
+        registry.remove('m3')
+
+        tokens = [_pay(first).token for _ in range(6)]
+        for api in (first, second):
+            results = list(api.payment_details_many(tokens, 6))
+            assert len(results) == 6
+        assert transport.max_in_flight == {'m1': 2, 'm2': 2}
+        assert transport.users.count('m2') == 6
+        assert transport.pool.connections_opened <= 4
+        snapshot = registry.snapshot()
+        assert snapshot['m1']['calls'][('Pay', 'SUCCESS')] == 6
+        assert snapshot['m2']['calls'][('PaymentDetails', 'SUCCESS')] == 6
+        registry.close()
+
+
+def test_payment_exporter():
+    payson = payson_fake.FakePayson()
+    api = payson_api.PaysonApi(
+        PAYSON_AGENT_ID, PAYSON_AGENT_KEY,
+        transport=payson_fake.FakePaysonTransport(payson))
+    tokens = [_pay(api, trackingId=u'ÅÄÖ %d' % i).token for i in range(10)]
+    tokens.insert(4, 'missing')
+
+    def interrupted():
+        for token in tokens[:8]:
+            yield token
+        raise RuntimeError('interrupted')
+
+    directory = tempfile.mkdtemp()
+    try:
+        # Interrupted after a checkpoint and before the first one
+        for checkpoint_every in (3, 1000):
+            path = os.path.join(directory, 'export%d.csv' % checkpoint_every)
+            checkpoint = path + '.checkpoint'
+            with open(path, 'wb') as sink:
+                exporter = payson_api.PaymentExporter(
+                    api, sink, max_concurrency=2, checkpoint_path=checkpoint,
+                    checkpoint_every=checkpoint_every)
+                try:
+                    exporter.export(interrupted())
+                except RuntimeError:
+                    pass
+                else:
+                    assert False, 'RuntimeError not raised'
+            with open(path, 'ab') as sink:
+                exporter = payson_api.PaymentExporter(
+                    api, sink, max_concurrency=2, checkpoint_path=checkpoint,
+                    checkpoint_every=checkpoint_every)
+                assert exporter.export(iter(tokens)) == (
+                    8 if checkpoint_every == 3 else len(tokens))
+                assert exporter.failed == 1
+            with open(path, 'rb') as f:
+                rows = list(csv.DictReader(f))
+            assert [row['token'] for row in rows] == tokens
+        assert rows[4]['error'] == '520004: Payment not found'
+        assert not rows[4]['status']
+        assert decimal.Decimal(rows[0]['amount']) == 125
+        assert rows[0]['trackingId'].decode('utf-8') == u'ÅÄÖ 0'
+        receivers = json.loads(rows[0]['receiverList'])
+        assert receivers[0]['email'] == receiver.email
+        assert decimal.Decimal(receivers[0]['amount']) == 125
+
+        sink = cStringIO.StringIO()
+        exporter = payson_api.PaymentExporter(api, sink, format='jsonl')
+        assert exporter.export(tokens[:2]) == 2
+        records = [json.loads(line) for line in sink.getvalue().splitlines()]
+        assert records[1]['token'] == tokens[1]
+        assert records[1]['status'] == 'CREATED'
+        assert records[1]['shippingAddress.name'] is None
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_pay_coalescing():
+    payson = payson_fake.FakePayson(latency=0.05)
+    coalescer = payson_api.PayCoalescer(window=60)
+    api = payson_api.PaysonApi(
+        PAYSON_AGENT_ID, PAYSON_AGENT_KEY,
+        transport=payson_fake.FakePaysonTransport(payson),
+        pay_coalescer=coalescer)
+
+    responses = []
+    threads = [threading.Thread(
+        target=lambda: responses.append(_pay(api, trackingId=u'order-1')))
+        for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert payson.requests['Pay'] == 1
+    assert coalescer.coalesced + coalescer.hits == 4
+    assert len(set(r.forward_pay_url for r in responses)) == 1
+    assert _pay(api, trackingId=u'order-1') is responses[0]
+    assert _pay(api, trackingId=u'order-2').token != responses[0].token
+    assert payson.requests['Pay'] == 2
+    other = _pay(api,
+                 receiverList=[payson_api.Receiver(
+                     email=receiver.email, amount=decimal.Decimal('999'))],
+                 trackingId=u'order-1')
+    assert other.token != responses[0].token
+    assert payson.requests['Pay'] == 3
+
+    payson.fail_next(status=503)
+    try:
+        _pay(api, idempotency_key='checkout-3')
+    except urllib2.HTTPError:
+        pass
+    else:
+        assert False, 'HTTPError not raised'
+    assert _pay(api, idempotency_key='checkout-3').success
+    _pay(api)
+    _pay(api)
+    assert payson.requests['Pay'] == 7
+
+    # pay keeps to the time budget, waiting for an ongoing call too
+    payson.latency = 0.5
+    api.timeout = 0.1
+    errors = []
+
+    def timed_pay():
+        start = time.time()
+        try:
+            _pay(api, trackingId=u'order-4')
+        except payson_api.DeadlineExceeded, e:
+            errors.append((e, time.time() - start))
+
+    threads = [threading.Thread(target=timed_pay) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 2
+    assert all(seconds < 0.4 for _, seconds in errors)
+
+
+def test_payment_update_many():
+    class LosingTransport(payson_fake.FakePaysonTransport):
+        """Loses the response of the first update of a token, and cannot 
+        look up details of unreachable tokens."""
+        lose = set()
+        unreachable = set()
+
+        def send(self, url, body, headers, timings=None, timeout=None):
+            token = urlparse.parse_qs(body).get('token', [None])[0]
+            if url.endswith('/PaymentDetails/') and token in self.unreachable:
+                raise urllib2.URLError('connection refused')
+            data = payson_fake.FakePaysonTransport.send(
+                self, url, body, headers, timings, timeout)
+            if url.endswith('/PaymentUpdate/') and token in self.lose:
+                self.lose.remove(token)
+                raise urllib2.URLError('connection reset')
+            return data
+
+    payson = payson_fake.FakePayson()
+    transport = LosingTransport(payson)
+    api = payson_api.PaysonApi(PAYSON_AGENT_ID, PAYSON_AGENT_KEY,
+                               transport=transport)
+    tokens = [_pay(api, fundingList=['INVOICE']).token for _ in range(8)]
+    for token in tokens[:7]:
+        payson.complete(token)
+    transport.lose.add(tokens[1])
+    payson.fail_next(1, status=503)
+    updates = [(token, 'SHIPORDER') for token in tokens]
+    progress = []
+    start = time.time()
+    results = dict((r.token, r) for r in api.payment_update_many(
+        iter(updates), max_concurrency=1, rate=100,
+        retry=payson_api.RetryPolicy(backoff=0.001),
+        progress=progress.append, progress_every=4))
+    assert time.time() - start >= 0.06
+    assert len(results) == 8
+    assert all(results[token].ack == 'SUCCESS' for token in tokens[:7])
+    assert results[tokens[0]].attempts == 2
+    assert results[tokens[1]].attempts == 1
+    assert payson.requests['PaymentUpdate'] == 9
+    failed = results[tokens[7]]
+    assert failed.ack == 'FAILURE' and failed.exception is None
+    assert failed.errorList[0].errorId == 580001
+    assert [p['done'] for p in progress] == [4, 8, 8]
+    assert progress[-1]['failed'] == 1 and progress[-1]['retried'] == 1
+    assert progress[-1]['throughput'] > 0
+    assert all(payson.payments[token]['invoiceStatus'] == 'SHIPPED'
+               for token in tokens[:7])
+
+    # Not sent again when it cannot be checked whether the update was applied
+    token = tokens[0]
+    transport.lose.add(token)
+    transport.unreachable.add(token)
+    result, = api.payment_update_many(
+        [(token, 'CREDITORDER')],
+        retry=payson_api.RetryPolicy(backoff=0.001))
+    assert payson.requests['PaymentUpdate'] == 10
+    assert result.ack is None and result.attempts == 1
+    assert isinstance(result.exception, urllib2.URLError)
+    assert str(result.exception.reason) == 'connection reset'
+    assert payson.payments[token]['invoiceStatus'] == 'CREDITED'
+
+
+def test_fake_payson_server():
+    with payson_fake.FakePaysonServer() as server:
+        api = payson_api.PaysonApi(PAYSON_AGENT_ID, PAYSON_AGENT_KEY,
+                                   endpoint=server.url)
+        _fake_flow(api, server.payson)
+        assert server.payson.requests['Validate'] == 2
+        api.close()
+
+
+def test_call_listeners():
+    class Recorder(payson_api.CallListener):
+        def __init__(self):
+            self.started = []
+            self.finished = []
+
+        def call_started(self, event):
+            self.started.append(event.action)
+
+        def call_finished(self, event):
+            self.finished.append(event)
+
+    class Broken(payson_api.CallListener):
+        def call_finished(self, event):
+            raise RuntimeError('ignored')
+
+    with payson_fake.FakePaysonServer() as server:
+        api = payson_api.PaysonApi(PAYSON_AGENT_ID, PAYSON_AGENT_KEY,
+                                   endpoint=server.url)
+        recorder = Recorder()
+        metrics = payson_api.MetricsListener()
+        for listener in (recorder, Broken(), metrics):
+            api.add_listener(listener)
+        r = _pay(api)
+        api.payment_details(r.token)
+        assert not api.payment_update(r.token, 'SHIPORDER')
+        assert not api.validate('token=' + r.token)
+        server.payson.fail_next(status=500)
+        try:
+            api.payment_details(r.token)
+        except urllib2.HTTPError:
+            pass
+        api.close()
+
+    assert recorder.started == ['Pay', 'PaymentDetails', 'PaymentUpdate',
+                                'Validate', 'PaymentDetails']
+    pay, details, update, validate, failed = recorder.finished
+    assert pay.ack == 'SUCCESS' and pay.exception is None
+    assert pay.timings['connect'] > 0
+    assert details.timings['connect'] == 0
+    assert set(details.timings) == set(['connect', 'send', 'wait', 'parse'])
+    assert details.response_size > 0 and details.duration > 0
+    assert update.ack == 'FAILURE' and update.error_ids == [580001]
+    assert validate.ack == 'INVALID'
+    assert isinstance(failed.exception, urllib2.HTTPError)
+    snapshot = metrics.snapshot()
+    assert snapshot['calls'][('PaymentDetails', 'SUCCESS')] == 1
+    assert snapshot['calls'][('PaymentDetails', 'HTTPError')] == 1
+    assert snapshot['errors'][('PaymentUpdate', 580001)] == 1
+    assert snapshot['latency'][('Pay', 'total')]['count'] == 1